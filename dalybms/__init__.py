@@ -1,7 +1,15 @@
 from .daly_bms import DalyBMS
+from .daly_bms_bus import DalyBMSBus
 from .daly_sinowealth import DalyBMSSinowealth
+from .daly_bms_async import AsyncDalyBMS, AsyncDalyBMSSinowealth
 try:
     from .daly_bms_bluetooth import DalyBMSBluetooth
+    from .bluetooth_manager import DalyBMSBluetoothManager
 except ImportError:
     # Bluetooth is optional and requires bleak to be installed
-    pass
\ No newline at end of file
+    pass
+try:
+    from . import batch
+except ImportError:
+    # the batch decoder is optional and requires numpy to be installed
+    pass
@@ -0,0 +1,137 @@
+"""
+Table driven decoding of alarm bit fields and tracking of their changes.
+
+An alarm state is a plain int with one bit per alarm, e.g. the 8 bytes of the Daly battery failure status with
+bit 0 of the first byte as bit 0. AlarmDecoder turns it into names with one precomputed table per byte,
+AlarmTracker compares it to the previous state and returns events for the bits that changed only.
+"""
+import time
+
+from .error_codes import ERROR_CODES
+
+
+class AlarmDecoder:
+    def __init__(self, names, msb_first=False):
+        """
+
+        :param names: Dict of bit number -> alarm name, bit 0 is the least significant bit
+        :param msb_first: Whether decode() lists the names from the most significant bit down (Default: False)
+        """
+        self.names = dict(names)
+        self.msb_first = msb_first
+        size = (max(self.names) // 8 + 1) if self.names else 0
+        # byte index -> tuple of 256 tuples of names, one per value of the byte
+        self.tables = tuple(self._byte_table(byte_index) for byte_index in range(size))
+        self.mask = sum(1 << bit for bit in self.names)
+
+    @classmethod
+    def from_byte_codes(cls, codes):
+        """
+        :param codes: Dict of byte index -> list of names for bit 0 to 7, like ERROR_CODES
+        """
+        return cls({byte_index * 8 + bit_index: name
+                    for byte_index, byte_names in codes.items()
+                    for bit_index, name in enumerate(byte_names)})
+
+    def _byte_table(self, byte_index):
+        byte_names = [(bit_index, self.names[byte_index * 8 + bit_index]) for bit_index in range(8)
+                      if byte_index * 8 + bit_index in self.names]
+        if self.msb_first:
+            byte_names.reverse()
+        return tuple(tuple(name for bit_index, name in byte_names if value >> bit_index & 1)
+                     for value in range(256))
+
+    def decode(self, mask):
+        """
+        :param mask: Alarm state
+        :return: List of the names of the set bits, ordered by bit number, see msb_first
+        """
+        if self.msb_first:
+            return [name for byte_index in range(len(self.tables) - 1, -1, -1)
+                    for name in self.tables[byte_index][mask >> byte_index * 8 & 0xFF]]
+        names = []
+        for table in self.tables:
+            if not mask:
+                break
+            names.extend(table[mask & 0xFF])
+            mask >>= 8
+        return names
+
+    def bits(self, mask):
+        """
+        :return: List of the set bit numbers that have a name
+        """
+        mask &= self.mask
+        bits = []
+        while mask:
+            low = mask & -mask
+            bits.append(low.bit_length() - 1)
+            mask ^= low
+        return bits
+
+
+class AlarmEvent:
+    __slots__ = ("timestamp", "raised", "bit", "name")
+
+    def __init__(self, timestamp, raised, bit, name):
+        self.timestamp = timestamp
+        self.raised = raised  # True if the alarm started, False if it was cleared
+        self.bit = bit
+        self.name = name
+
+    def to_dict(self):
+        return {
+            "timestamp": self.timestamp,
+            "event": "raised" if self.raised else "cleared",
+            "bit": self.bit,
+            "name": self.name,
+        }
+
+
+class AlarmTracker:
+    """
+    Keeps the alarm state of one BMS, e.g.
+
+        tracker = AlarmTracker(bms.ALARMS)
+        for event in tracker.update(bms.get_error_mask()):
+            print(event.to_dict())
+    """
+
+    def __init__(self, decoder):
+        """
+
+        :param decoder: AlarmDecoder of the BMS type, e.g. DalyBMS.ALARMS
+        """
+        self.decoder = decoder
+        self.mask = None  # None until the first successful read
+        self.changed = None  # unix timestamp of the last change
+
+    def update(self, mask, timestamp=None):
+        """
+        :param mask: Alarm state, a records.Errors object or False/None for a failed read, which is ignored
+        :param timestamp: Unix timestamp of the read (Default: now)
+        :return: List of AlarmEvent objects, empty if nothing changed. The first read raises all set alarms.
+        """
+        mask = getattr(mask, "mask", mask)
+        if mask is None or mask is False:
+            return []
+        previous = self.mask or 0
+        self.mask = mask
+        changed = (previous ^ mask) & self.decoder.mask
+        if not changed:
+            return []
+        if timestamp is None:
+            timestamp = time.time()
+        self.changed = timestamp
+        return [AlarmEvent(timestamp, bool(mask >> bit & 1), bit, self.decoder.names[bit])
+                for bit in self.decoder.bits(changed)]
+
+    @property
+    def active(self):
+        """
+        :return: List of the names of the current alarms
+        """
+        return self.decoder.decode(self.mask or 0)
+
+
+DALY_ALARMS = AlarmDecoder.from_byte_codes(ERROR_CODES)
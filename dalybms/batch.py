@@ -0,0 +1,112 @@
+"""
+Vectorized decoding of many cell voltage (0x95) and temperature (0x96) responses at once.
+
+Requires numpy. Every snapshot is a list of the 8 byte response data of one command, as returned by
+DalyBMS._read_request(..., return_list=True) or taken from a capture file.
+"""
+import math
+
+import numpy as np
+
+CELL_VOLTAGE_FRAME = np.dtype([("frame", "u1"), ("values", ">i2", (3,)), ("reserved", "u1")])
+TEMPERATURE_FRAME = np.dtype([("frame", "u1"), ("values", "i1", (7,))])
+
+
+def _decode(snapshots, dtype, count):
+    per_frame = dtype["values"].shape[0]
+    frames_per_snapshot = math.ceil(count / per_frame)
+    lengths = [len(snapshot) for snapshot in snapshots]
+    buffer = b"".join(bytes(data) for snapshot in snapshots for data in snapshot)
+    frames = np.frombuffer(buffer, dtype=dtype)
+
+    snapshot_index = np.repeat(np.arange(len(snapshots)), lengths)
+    # frames are numbered from 1, frames with an invalid number are ignored
+    frame_index = frames["frame"].astype(np.intp) - 1
+    valid = (frame_index >= 0) & (frame_index < frames_per_snapshot)
+
+    values = np.full((len(snapshots), frames_per_snapshot, per_frame), np.nan)
+    values[snapshot_index[valid], frame_index[valid]] = frames["values"][valid]
+    return values.reshape(len(snapshots), -1)[:, :count]
+
+
+def decode_cell_voltages(snapshots, cells):
+    """
+    :param snapshots: List of snapshots, each a list of 0x95 response data
+    :param cells: Number of cells
+    :return: Array of shape (snapshots, cells) with the voltages in V, NaN for missing frames
+    """
+    return _decode(snapshots, CELL_VOLTAGE_FRAME, cells) / 1000
+
+
+def decode_temperatures(snapshots, sensors):
+    """
+    :param snapshots: List of snapshots, each a list of 0x96 response data
+    :param sensors: Number of temperature sensors
+    :return: Array of shape (snapshots, sensors) with the temperatures in °C, NaN for missing frames
+    """
+    return _decode(snapshots, TEMPERATURE_FRAME, sensors) - 40
+
+
+def statistics(values):
+    """
+    Per snapshot statistics of decoded cell voltages or temperatures, missing values are ignored
+
+    :param values: Array of shape (snapshots, cells) from decode_cell_voltages or decode_temperatures
+    :return: Dict of name -> array of shape (snapshots,), the cell/sensor numbers start with 1
+    """
+    missing = np.isnan(values)
+    counts = (~missing).sum(axis=1)
+    complete = counts > 0
+    filled_low = np.where(missing, np.inf, values)
+    filled_high = np.where(missing, -np.inf, values)
+    lowest = filled_low.min(axis=1)
+    highest = filled_high.max(axis=1)
+    return {
+        "lowest": np.where(complete, lowest, np.nan),
+        "lowest_cell": np.where(complete, filled_low.argmin(axis=1) + 1, 0),
+        "highest": np.where(complete, highest, np.nan),
+        "highest_cell": np.where(complete, filled_high.argmax(axis=1) + 1, 0),
+        "spread": np.where(complete, highest - lowest, np.nan),
+        "mean": np.where(complete, np.where(missing, 0, values).sum(axis=1) / np.maximum(counts, 1), np.nan),
+    }
+
+
+class SnapshotBatch:
+    """
+    Collects the raw cell voltage and temperature responses of many live reads, so that they get
+    decoded in one go instead of building dicts for every read.
+    """
+
+    def __init__(self, cells, temperature_sensors):
+        """
+
+        :param cells: Number of cells
+        :param temperature_sensors: Number of temperature sensors
+        """
+        self.cells = cells
+        self.temperature_sensors = temperature_sensors
+        self.cell_voltage_data = []
+        self.temperature_data = []
+
+    def read(self, bms):
+        """
+        Reads the cell voltages and temperatures from a BMS without decoding them
+
+        :param bms: Connected DalyBMS object
+        :return: True if both commands got a response
+        """
+        if not bms.status:
+            bms.get_status()
+        cell_voltage_data = bms._read_request("95", max_responses=bms._expected_responses("95"),
+                                              return_list=True)
+        temperature_data = bms._read_request("96", max_responses=bms._expected_responses("96"),
+                                             return_list=True)
+        self.cell_voltage_data.append(cell_voltage_data or [])
+        self.temperature_data.append(temperature_data or [])
+        return bool(cell_voltage_data and temperature_data)
+
+    def cell_voltages(self):
+        return decode_cell_voltages(self.cell_voltage_data, self.cells)
+
+    def temperatures(self):
+        return decode_temperatures(self.temperature_data, self.temperature_sensors)
@@ -0,0 +1,254 @@
+"""
+Benchmark of the read path against the simulator.
+
+Run with `python3 -m dalybms.benchmark`, every measurement gets printed as one JSON object per line.
+"""
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+
+from .daly_bms import DalyBMS
+from .daly_sinowealth import DalyBMSSinowealth
+from .simulator import DalyBMSSimulator
+
+DALY_COMMANDS = {
+    "get_soc": "90",
+    "get_cell_voltage_range": "91",
+    "get_temperature_range": "92",
+    "get_mosfet_status": "93",
+    "get_status": "94",
+    "get_cell_voltages": "95",
+    "get_temperatures": "96",
+    "get_balancing_status": "97",
+    "get_errors": "98",
+}
+
+
+class _RetryCounter:
+    """
+    Counts the requests a BMS object sends, single ones and the commands of pipelined reads.
+    Within one call of a getter every request after the first one for the same command is a retry.
+    """
+
+    def __init__(self, bms):
+        self.retries = 0
+        self._tries = 0
+        self._commands = set()
+        self._read = bms._read
+        self._read_pipeline = bms._read_pipeline
+        bms._read = self.read
+        bms._read_pipeline = self.read_pipeline
+
+    def wrap(self, function):
+        def call():
+            self._tries = 0
+            self._commands.clear()
+            try:
+                return function()
+            finally:
+                self.retries += self._tries - len(self._commands)
+        return call
+
+    def read(self, command, *args, **kwargs):
+        self._tries += 1
+        self._commands.add(command)
+        return self._read(command, *args, **kwargs)
+
+    def read_pipeline(self, requests):
+        self._tries += len(requests)
+        self._commands.update(requests)
+        return self._read_pipeline(requests)
+
+
+def measure(function, iterations):
+    """
+    Calls a function several times and measures the wall time and the CPU time of the calling thread.
+    The simulator runs in its own thread, so the difference between both is the time spent waiting for the bus.
+
+    :return: Dict with the timings in seconds
+    """
+    wall_times = []
+    cpu_total = 0
+    failures = 0
+    for _ in range(iterations):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        result = function()
+        cpu_total += time.thread_time() - cpu_start
+        wall_times.append(time.perf_counter() - wall_start)
+        if result is False or result is None:
+            failures += 1
+    wall_total = sum(wall_times)
+    return {
+        "iterations": iterations,
+        "failures": failures,
+        "wall_mean": wall_total / iterations,
+        "wall_median": statistics.median(wall_times),
+        "wall_max": max(wall_times),
+        "per_second": iterations / wall_total if wall_total else None,
+        "cpu_seconds": cpu_total,
+        "wait_seconds": max(wall_total - cpu_total, 0),
+    }
+
+
+def measure_parser(function, response_data, iterations):
+    """
+    :return: Seconds per call of a parser with captured response data
+    """
+    start = time.thread_time()
+    for _ in range(iterations):
+        function(response_data=response_data)
+    return (time.thread_time() - start) / iterations
+
+
+def benchmark_daly(simulator_options, iterations, parser_iterations):
+    simulator = DalyBMSSimulator(**simulator_options)
+    device = simulator.open()
+    # without the cache every call reaches the simulator
+    bms = DalyBMS(request_retries=3, cache_ttls={})
+    try:
+        bms.connect(device)
+        counter = _RetryCounter(bms)
+        for method, command in DALY_COMMANDS.items():
+            counter.retries = 0
+            requests = simulator.requests
+            result = measure(counter.wrap(getattr(bms, method)), iterations)
+            result["command"] = method
+            result["retries"] = counter.retries
+            result["requests"] = simulator.requests - requests
+            response_data = bms._read_request(command, max_responses=bms._expected_responses(command),
+                                              return_list=command in ("95", "96"))
+            if response_data:
+                result["parse_seconds"] = measure_parser(getattr(bms, method), response_data, parser_iterations)
+            yield result
+
+        for method in ("get_all", "get_all_pipelined", "get_snapshot"):
+            counter.retries = 0
+            requests = simulator.requests
+            result = measure(counter.wrap(getattr(bms, method)), iterations)
+            result["command"] = method
+            result["retries"] = counter.retries
+            result["requests"] = simulator.requests - requests
+            yield result
+    finally:
+        bms.disconnect()
+        simulator.close()
+
+
+def check_pipeline(simulator_options, iterations=5):
+    """
+    Regression check of the pipelined snapshot: with a latency above frame_gap_timeout all commands have to be
+    answered within the one round trip, without repeating any of them
+
+    :return: Dict with the result, "ok" is False if a snapshot was incomplete or needed more requests
+    """
+    bms = DalyBMS(request_retries=3, cache_ttls={})
+    options = dict(simulator_options, latency=max(simulator_options["latency"], bms.frame_gap_timeout * 2),
+                   drop_rate=0, corrupt_rate=0)
+    simulator = DalyBMSSimulator(**options)
+    device = simulator.open()
+    try:
+        bms.connect(device)
+        commands = len(bms._snapshot_requests())
+        requests = simulator.requests
+        complete = 0
+        for _ in range(iterations):
+            snapshot = bms.get_snapshot().to_dict()
+            complete += all(value is not False for value in snapshot.values())
+        requests = simulator.requests - requests
+        return {
+            "check": "pipeline",
+            "latency": options["latency"],
+            "iterations": iterations,
+            "complete": complete,
+            "requests": requests,
+            "ok": complete == iterations and requests == iterations * commands,
+        }
+    finally:
+        bms.disconnect()
+        simulator.close()
+
+
+def benchmark_sinowealth(simulator_options, iterations):
+    simulator = DalyBMSSimulator(sinowealth=True, **simulator_options)
+    device = simulator.open()
+    bms = DalyBMSSinowealth()
+    try:
+        bms.connect(device)
+        for method in ("get_soc", "get_cell_voltages", "get_temperatures", "get_mosfet_status", "get_errors",
+                       "get_all"):
+            requests = simulator.requests
+            result = measure(getattr(bms, method), iterations)
+            result["command"] = method
+            result["requests"] = simulator.requests - requests
+            yield result
+    finally:
+        bms.disconnect()
+        simulator.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the read path against the simulator")
+    parser.add_argument("--cells", help="comma separated cell counts, default 4,16,48", type=str, default="4,16,48")
+    parser.add_argument("--corrupt-rates", help="comma separated shares of corrupted responses, default 0,0.02",
+                        type=str, default="0,0.02")
+    parser.add_argument("--drop-rate", help="share of requests without response, default 0", type=float,
+                        default=0)
+    parser.add_argument("--latency", help="response latency in seconds, default 0.01", type=float, default=0.01)
+    parser.add_argument("--baudrate", help="simulated baud rate, 0 to disable, default 9600", type=int,
+                        default=9600)
+    parser.add_argument("--iterations", help="iterations per command, default 20", type=int, default=20)
+    parser.add_argument("--parser-iterations", help="iterations per parser, default 10000", type=int,
+                        default=10000)
+    parser.add_argument("--sinowealth", help="also benchmark the Sinowealth protocol", action="store_true")
+    parser.add_argument("--seed", help="seed for the simulator, default 1", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file instead of stdout", type=str)
+    parser.add_argument("--check", help="only check that a pipelined snapshot with a latency above the frame gap "
+                                        "timeout needs one round trip, exits with 1 if not", action="store_true")
+    args = parser.parse_args(argv)
+
+    # failed reads get counted, they don't need to show up as errors
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if args.check:
+        result = check_pipeline({"cells": 16, "baudrate": args.baudrate, "latency": args.latency,
+                                 "seed": args.seed})
+        print(json.dumps(result))
+        sys.exit(0 if result["ok"] else 1)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for cells in [int(x) for x in args.cells.split(",")]:
+            for corrupt_rate in [float(x) for x in args.corrupt_rates.split(",")]:
+                simulator_options = {
+                    "cells": cells,
+                    "baudrate": args.baudrate,
+                    "latency": args.latency,
+                    "drop_rate": args.drop_rate,
+                    "corrupt_rate": corrupt_rate,
+                    "seed": args.seed,
+                }
+                results = [("daly", result) for result in
+                           benchmark_daly(simulator_options, args.iterations, args.parser_iterations)]
+                if args.sinowealth and cells <= 10:
+                    results += [("sinowealth", result) for result in
+                                benchmark_sinowealth(simulator_options, args.iterations)]
+                for protocol, result in results:
+                    result.update({
+                        "protocol": protocol,
+                        "cells": cells,
+                        "corrupt_rate": corrupt_rate,
+                        "drop_rate": args.drop_rate,
+                    })
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+
+from .daly_bms_bluetooth import DalyBMSBluetooth
+
+
+class DalyBMSBluetoothManager:
+    """
+    Polls several Bluetooth BMS from one event loop. Connections are kept open between polls and get
+    reestablished with an exponential backoff. The number of simultaneous connection attempts, connections
+    and polls is limited, as most Bluetooth adapters only handle a few of each at a time.
+    When there are more BMS than connections, they take turns and get disconnected after every poll.
+    """
+
+    def __init__(self, interval=10, max_connections=7, max_connecting=1, max_polling=3, reconnect_delay=1,
+                 max_reconnect_delay=60, client_factory=None, logger=None):
+        """
+
+        :param interval: Seconds between two polls of the same BMS (Default: 10)
+        :param max_connections: Connections the adapter can keep open at the same time (Default: 7)
+        :param max_connecting: Simultaneous connection attempts (Default: 1)
+        :param max_polling: BMS that get polled at the same time (Default: 3)
+        :param reconnect_delay: Seconds before the first reconnect, doubled after every failure (Default: 1)
+        :param max_reconnect_delay: Upper limit of the reconnect delay in seconds (Default: 60)
+        :param client_factory: Function that takes the MAC address and returns a BleakClient compatible object,
+                               e.g. a fake client for tests (Default: BleakClient)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.interval = interval
+        self.max_connections = max_connections
+        self.max_connecting = max_connecting
+        self.max_polling = max_polling
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.client_factory = client_factory
+        self.devices = {}
+        # created by the first poll, asyncio objects bind to the event loop that is running when they get created
+        # on Python < 3.10
+        self._connections = None
+        self._connecting = None
+        self._polling = None
+
+    def add_bms(self, mac_address, **kwargs):
+        """
+        :param mac_address: MAC address of the Bluetooth device
+        :param kwargs: Further arguments for DalyBMSBluetooth, e.g. request_retries
+        :return: DalyBMSBluetooth object for this device
+        """
+        if mac_address in self.devices:
+            raise ValueError("%s was already added" % mac_address)
+        kwargs.setdefault("logger", self.logger)
+        kwargs.setdefault("client_factory", self.client_factory)
+        bms = DalyBMSBluetooth(**kwargs)
+        self.devices[mac_address] = _Device(mac_address, bms)
+        return bms
+
+    @property
+    def persistent(self):
+        """
+        Whether all BMS can stay connected at the same time
+        """
+        return len(self.devices) <= self.max_connections
+
+    async def _connect(self, device):
+        """
+        :return: True if the device is connected
+        """
+        if device.bms.is_connected:
+            return True
+        wait = device.next_attempt - time.monotonic()
+        if wait > 0:
+            self.logger.debug("%s: next connection attempt in %.1f seconds", device.mac_address, wait)
+            return False
+        if not device.has_slot:
+            await self._connections.acquire()
+            device.has_slot = True
+        try:
+            async with self._connecting:
+                self.logger.info("%s: connecting", device.mac_address)
+                await device.bms.connect(device.mac_address)
+        except Exception as e:
+            self.logger.warning("%s: connection failed: %s", device.mac_address, e)
+            await self._disconnect(device)
+            self._failed(device)
+            return False
+        return True
+
+    async def _disconnect(self, device):
+        try:
+            if device.bms.is_connected:
+                await device.bms.disconnect()
+        except Exception as e:
+            self.logger.debug("%s: disconnect failed: %s", device.mac_address, e)
+        finally:
+            if device.has_slot:
+                device.has_slot = False
+                self._connections.release()
+
+    def _failed(self, device):
+        device.failures += 1
+        delay = min(self.reconnect_delay * 2 ** (device.failures - 1), self.max_reconnect_delay)
+        device.next_attempt = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+    async def poll(self, mac_address, method="get_all"):
+        """
+        Connects if necessary and calls a method of the BMS
+
+        :param mac_address: MAC address of the Bluetooth device
+        :param method: Name of the DalyBMSBluetooth method (Default: get_all)
+        :return: Result of the method, or None if the device is not reachable
+        """
+        device = self.devices[mac_address]
+        if self._polling is None:
+            self._connections = asyncio.Semaphore(self.max_connections)
+            self._connecting = asyncio.Semaphore(self.max_connecting)
+            self._polling = asyncio.Semaphore(self.max_polling)
+        if device.lock is None:
+            device.lock = asyncio.Lock()
+        async with device.lock:
+            if not await self._connect(device):
+                return None
+            try:
+                async with self._polling:
+                    result = await getattr(device.bms, method)()
+            except Exception as e:
+                self.logger.warning("%s: %s failed: %s", mac_address, method, e)
+                await self._disconnect(device)
+                self._failed(device)
+                return None
+            if not _has_data(result):
+                # the connection may be up without the BMS responding, a fresh connection often helps
+                self.logger.warning("%s: no response", mac_address)
+                await self._disconnect(device)
+                self._failed(device)
+                return result
+            device.failures = 0
+            device.next_attempt = 0
+            if not self.persistent:
+                await self._disconnect(device)
+            return result
+
+    async def poll_all(self, method="get_all"):
+        """
+        Polls all BMS once
+
+        :return: Dict of MAC address -> result, None for unreachable devices
+        """
+        addresses = list(self.devices)
+        results = await asyncio.gather(*[self.poll(mac_address, method) for mac_address in addresses])
+        return dict(zip(addresses, results))
+
+    async def run(self, callback, method="get_all", cycles=None):
+        """
+        Polls every BMS each 'interval' seconds until cancelled. The start times of the devices are spread over
+        the interval, so the polls don't all hit the adapter at the same moment.
+
+        :param callback: Function or coroutine function (mac_address, result) called after every poll
+        :param method: Name of the DalyBMSBluetooth method (Default: get_all)
+        :param cycles: Number of polls per device, None runs forever (Default: None)
+        """
+        addresses = list(self.devices)
+        try:
+            await asyncio.gather(*[
+                self._run_device(mac_address, callback, method, cycles, index * self.interval / len(addresses))
+                for index, mac_address in enumerate(addresses)
+            ])
+        finally:
+            await self.disconnect()
+
+    async def _run_device(self, mac_address, callback, method, cycles, offset):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + offset
+        count = 0
+        while cycles is None or count < cycles:
+            await asyncio.sleep(max(next_poll - loop.time(), 0))
+            result = await self.poll(mac_address, method)
+            outcome = callback(mac_address, result)
+            if inspect.isawaitable(outcome):
+                await outcome
+            count += 1
+            next_poll += self.interval
+            if next_poll < loop.time():
+                # don't try to catch up on missed polls
+                next_poll = loop.time()
+
+    async def disconnect(self):
+        for device in self.devices.values():
+            await self._disconnect(device)
+
+
+class _Device:
+    def __init__(self, mac_address, bms):
+        self.mac_address = mac_address
+        self.bms = bms
+        self.failures = 0
+        self.next_attempt = 0
+        self.has_slot = False
+        self.lock = None
+
+
+def _has_data(result):
+    if isinstance(result, dict):
+        return any(result.values())
+    return bool(result)
@@ -0,0 +1,59 @@
+import contextlib
+import time
+
+
+class ResponseCache:
+    """
+    Keeps the responses of slowly changing commands or registers for a configurable time,
+    so that repeated reads don't cost a round trip on the bus.
+    """
+
+    def __init__(self, ttls=None):
+        """
+
+        :param ttls: Dict of command ID or register -> seconds a response stays valid,
+                     commands that are not listed are never cached (Default: nothing is cached)
+        """
+        self.ttls = dict(ttls or {})
+        self.entries = {}  # command -> (timestamp, response data)
+        self._fresh = 0
+
+    def get(self, command):
+        """
+        :return: Cached response data, or None if there is no valid entry or fresh reads are forced
+        """
+        if self._fresh:
+            return None
+        entry = self.entries.get(command)
+        if entry is None:
+            return None
+        timestamp, response_data = entry
+        if time.monotonic() - timestamp > self.ttls.get(command, 0):
+            del self.entries[command]
+            return None
+        return response_data
+
+    def put(self, command, response_data):
+        if self.ttls.get(command) and response_data is not None and response_data is not False:
+            self.entries[command] = (time.monotonic(), response_data)
+
+    def invalidate(self, *commands):
+        """
+        Drops the cached responses of some commands, or all if none are given
+        """
+        if not commands:
+            self.entries.clear()
+            return
+        for command in commands:
+            self.entries.pop(command, None)
+
+    @contextlib.contextmanager
+    def fresh(self):
+        """
+        Context manager that bypasses the cache, the responses read within it still get cached
+        """
+        self._fresh += 1
+        try:
+            yield
+        finally:
+            self._fresh -= 1
@@ -0,0 +1,188 @@
+"""
+Binary capture of the request and response frames of the Daly protocol.
+
+File layout: a header (magic, wall clock time and monotonic time at the creation of the file),
+followed by records of (monotonic timestamp, direction, frame length) and the frame itself.
+"""
+import mmap
+import os
+import struct
+import time
+
+from .daly_bms import DalyBMS
+
+MAGIC = b"DALYCAP1"
+HEADER = struct.Struct("<8s d d")
+RECORD = struct.Struct("<d B H")
+
+REQUEST = 0
+RESPONSE = 1
+
+
+class CaptureWriter:
+    """
+    Appends frames to a capture file, attach it to a BMS with DalyBMS(capture=...)
+    """
+
+    def __init__(self, path, buffer_size=65536):
+        """
+
+        :param path: Path of the capture file, new frames get appended if it exists
+        :param buffer_size: Size of the write buffer in bytes (Default: 65536)
+        """
+        self.path = path
+        self.file = open(path, "ab", buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, time.time(), time.monotonic()))
+
+    def write(self, direction, frame, timestamp=None):
+        """
+        :param direction: REQUEST or RESPONSE
+        :param frame: Complete frame
+        :param timestamp: Monotonic timestamp (Default: now)
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.file.write(RECORD.pack(timestamp, direction, len(frame)))
+        self.file.write(frame)
+
+    def write_response(self, frame, timestamp=None):
+        self.write(RESPONSE, frame, timestamp=timestamp)
+
+    def write_requests(self, message_bytes, timestamp=None):
+        """
+        Writes one or more request frames that got sent at once
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        for offset in range(0, len(message_bytes), 13):
+            self.write(REQUEST, message_bytes[offset:offset + 13], timestamp=timestamp)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture file through a memory map, the frames are returned as memoryviews without copying them
+    """
+
+    # command ID -> parser of DalyBMS
+    PARSERS = {
+        "90": "get_soc",
+        "91": "get_cell_voltage_range",
+        "92": "get_temperature_range",
+        "93": "get_mosfet_status",
+        "94": "get_status",
+        "95": "get_cell_voltages",
+        "96": "get_temperatures",
+        "97": "get_balancing_status",
+        "98": "get_errors",
+    }
+
+    def __init__(self, path):
+        """
+
+        :param path: Path of the capture file
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        if os.fstat(self.file.fileno()).st_size < HEADER.size:
+            raise ValueError("%s is not a capture file" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wall_time, self.monotonic_time = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a capture file" % path)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def to_wall_time(self, timestamp):
+        """
+        Converts a monotonic timestamp of this file to a unix timestamp
+        """
+        return timestamp - self.monotonic_time + self.wall_time
+
+    def __iter__(self):
+        """
+        :return: Iterator of (timestamp, direction, frame)
+        """
+        view = memoryview(self.map)
+        offset = HEADER.size
+        end = len(self.map)
+        try:
+            while offset + RECORD.size <= end:
+                timestamp, direction, length = RECORD.unpack_from(view, offset)
+                offset += RECORD.size
+                if offset + length > end:
+                    # the last record was cut off
+                    break
+                yield timestamp, direction, view[offset:offset + length]
+                offset += length
+        finally:
+            view.release()
+
+    def replay(self, bms=None):
+        """
+        Decodes the captured responses with the parsers of DalyBMS. Cell voltages, temperatures and
+        the balancing status can only be decoded after a status response.
+
+        :param bms: DalyBMS object used for parsing, its status gets updated (Default: new DalyBMS)
+        :return: Iterator of (timestamp, command ID, result)
+        """
+        if bms is None:
+            bms = DalyBMS()
+        pending = {}
+        for timestamp, direction, frame in self:
+            command = "%02x" % frame[2]
+            if command not in self.PARSERS:
+                continue
+            if direction == REQUEST:
+                if pending.get(command):
+                    yield self._parse(bms, command, pending[command])
+                pending[command] = []
+                continue
+
+            data = frame[4:-1]
+            if command in ("95", "96"):
+                frames = pending.setdefault(command, [])
+                if not frames:
+                    frames.append(timestamp)
+                frames.append(data)
+                if bms.status and len(frames) - 1 == bms._expected_responses(command):
+                    yield self._parse(bms, command, frames)
+                    pending[command] = []
+            else:
+                pending[command] = []
+                yield self._parse(bms, command, [timestamp, data])
+
+        for command, frames in pending.items():
+            if frames:
+                yield self._parse(bms, command, frames)
+
+    def _parse(self, bms, command, frames):
+        timestamp = frames[0]
+        response_data = frames[1:]
+        if command in ("95", "96", "97") and not bms.status:
+            return timestamp, command, None
+        if command not in ("95", "96"):
+            response_data = response_data[0]
+        # call the parsers of DalyBMS directly, subclasses might wrap them in coroutines
+        return timestamp, command, getattr(DalyBMS, self.PARSERS[command])(bms, response_data=response_data)
@@ -0,0 +1,271 @@
+"""
+Long term statistics of the cells and temperature sensors of a pack, see CellStatistics.
+
+The state only grows with the number of cells and sensors, not with the number of samples.
+"""
+import math
+import time
+from array import array
+
+DEFAULT_SPREAD_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.1, 0.2)
+
+
+def _values(data):
+    """
+    :param data: Dict of cell or sensor -> value, a record with to_dict(), or False for a failed read
+    :return: Dict of cell or sensor -> value, or None
+    """
+    if hasattr(data, "to_dict"):
+        data = data.to_dict()
+    if not data or not isinstance(data, dict):
+        return None
+    return data
+
+
+def _section(data, key):
+    if isinstance(data, dict):
+        return data.get(key)
+    return getattr(data, key, None)
+
+
+class _Series:
+    """
+    Running statistics of a group of values that are read together, e.g. all cell voltages. The time spent
+    below 'low' or above 'high' is added up assuming a value stays the same until the next sample.
+    """
+
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+        self.keys = []
+        self.index = {}
+        self.count = array("L")
+        self.mean = array("d")
+        self.m2 = array("d")
+        self.minimum = array("d")
+        self.maximum = array("d")
+        self.time_low = array("d")
+        self.time_high = array("d")
+        self.previous = None  # values of the previous sample, by index
+        self.timestamp = None
+        self.observed = 0.0
+
+    def _add_key(self, key):
+        self.index[key] = len(self.keys)
+        self.keys.append(key)
+        for values, initial in ((self.count, 0), (self.mean, 0.0), (self.m2, 0.0), (self.minimum, math.inf),
+                                (self.maximum, -math.inf), (self.time_low, 0.0), (self.time_high, 0.0)):
+            values.append(initial)
+
+    def _elapsed(self, timestamp, max_gap):
+        """
+        :return: Seconds since the previous sample that count, 0 after a gap
+        """
+        if self.timestamp is None:
+            return 0
+        elapsed = timestamp - self.timestamp
+        if elapsed <= 0 or elapsed > max_gap:
+            return 0
+        return elapsed
+
+    def add(self, values, timestamp, max_gap):
+        """
+        :param values: Dict of key -> value, None values are skipped
+        :return: List of the values by index, None for missing ones
+        """
+        elapsed = self._elapsed(timestamp, max_gap)
+        if elapsed and self.previous is not None:
+            self.observed += elapsed
+            for index, value in enumerate(self.previous):
+                if value is None:
+                    continue
+                if self.low is not None and value < self.low:
+                    self.time_low[index] += elapsed
+                elif self.high is not None and value > self.high:
+                    self.time_high[index] += elapsed
+
+        for key in values:
+            if key not in self.index:
+                self._add_key(key)
+        current = [None] * len(self.keys)
+        for key, value in values.items():
+            if value is None or value is False:
+                continue
+            value = float(value)
+            if math.isnan(value):
+                continue
+            index = self.index[key]
+            current[index] = value
+            # Welford's algorithm
+            count = self.count[index] + 1
+            self.count[index] = count
+            delta = value - self.mean[index]
+            self.mean[index] += delta / count
+            self.m2[index] += delta * (value - self.mean[index])
+            if value < self.minimum[index]:
+                self.minimum[index] = value
+            if value > self.maximum[index]:
+                self.maximum[index] = value
+        self.previous = current
+        self.timestamp = timestamp
+        return current
+
+    def stdev(self, index):
+        count = self.count[index]
+        if count < 2:
+            return 0.0
+        return math.sqrt(self.m2[index] / (count - 1))
+
+    def to_dict(self, index):
+        if not self.count[index]:
+            return {"count": 0}
+        data = {
+            "count": self.count[index],
+            "mean": self.mean[index],
+            "stdev": self.stdev(index),
+            "min": self.minimum[index],
+            "max": self.maximum[index],
+        }
+        if self.low is not None:
+            data["time_low"] = self.time_low[index]
+        if self.high is not None:
+            data["time_high"] = self.time_high[index]
+        return data
+
+
+class CellStatistics:
+    """
+    Incremental per cell statistics of the cell voltages, temperatures and balancing status:
+    mean, standard deviation, minimum and maximum, the time spent outside of thresholds, the deviation of each cell
+    from the pack average (drift), a histogram of the spread between the highest and lowest cell and the share
+    of the time each cell was balancing. Feed it the results of get_all, get_snapshot or a stream, e.g.
+
+        statistics = CellStatistics(low_voltage=3.0, high_voltage=3.55)
+        for sample in bms.stream(interval=5, fields=("cell_voltages", "temperatures", "balancing_status")):
+            statistics.add(sample.data, sample.timestamp)
+    """
+
+    def __init__(self, low_voltage=None, high_voltage=None, low_temperature=None, high_temperature=None,
+                 spread_buckets=DEFAULT_SPREAD_BUCKETS, max_gap=300):
+        """
+
+        :param low_voltage: Cell voltage below which the time gets counted, in V (Default: None)
+        :param high_voltage: Cell voltage above which the time gets counted, in V (Default: None)
+        :param low_temperature: Temperature below which the time gets counted, in °C (Default: None)
+        :param high_temperature: Temperature above which the time gets counted, in °C (Default: None)
+        :param spread_buckets: Upper bounds of the spread histogram buckets in V (Default: DEFAULT_SPREAD_BUCKETS)
+        :param max_gap: Seconds between two samples up to which the time in between gets counted, longer gaps
+                        (e.g. the BMS was not reachable) are left out of the time based values (Default: 300)
+        """
+        self.max_gap = max_gap
+        self.voltages = _Series(low_voltage, high_voltage)
+        self.temperatures = _Series(low_temperature, high_temperature)
+        self.deviations = _Series()
+        self.balancing = _Series()
+        self.balancing_time = array("d")
+        self.spread_buckets = tuple(sorted(spread_buckets))
+        self.spread_counts = array("L", [0] * (len(self.spread_buckets) + 1))
+        self.spread = _Series()
+
+    def add(self, data, timestamp=None):
+        """
+        :param data: Result of get_all or get_snapshot, missing or failed sections are skipped
+        :param timestamp: Unix timestamp of the read (Default: now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.add_cell_voltages(_section(data, "cell_voltages"), timestamp)
+        self.add_temperatures(_section(data, "temperatures"), timestamp)
+        self.add_balancing_status(_section(data, "balancing_status"), timestamp)
+
+    def add_cell_voltages(self, cell_voltages, timestamp=None):
+        """
+        :param cell_voltages: Result of get_cell_voltages or records.CellVoltages
+        :param timestamp: Unix timestamp of the read (Default: now)
+        """
+        values = _values(cell_voltages)
+        if values is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        current = [value for value in self.voltages.add(values, timestamp, self.max_gap) if value is not None]
+        if not current:
+            return
+        average = sum(current) / len(current)
+        self.deviations.add({cell: None if value is None or value is False else value - average
+                             for cell, value in values.items()}, timestamp, self.max_gap)
+        spread = max(current) - min(current)
+        self.spread.add({"spread": spread}, timestamp, self.max_gap)
+        for index, bound in enumerate(self.spread_buckets):
+            if spread <= bound:
+                self.spread_counts[index] += 1
+                break
+        else:
+            self.spread_counts[-1] += 1
+
+    def add_temperatures(self, temperatures, timestamp=None):
+        """
+        :param temperatures: Result of get_temperatures or records.Temperatures
+        :param timestamp: Unix timestamp of the read (Default: now)
+        """
+        values = _values(temperatures)
+        if values is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        self.temperatures.add(values, timestamp, self.max_gap)
+
+    def add_balancing_status(self, balancing_status, timestamp=None):
+        """
+        :param balancing_status: Result of get_balancing_status or records.BalancingStatus
+        :param timestamp: Unix timestamp of the read (Default: now)
+        """
+        values = _values(balancing_status)
+        if values is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        series = self.balancing
+        elapsed = series._elapsed(timestamp, self.max_gap)
+        if elapsed and series.previous is not None:
+            for index, value in enumerate(series.previous):
+                if value:
+                    self.balancing_time[index] += elapsed
+        series.add({cell: 1.0 if value else 0.0 for cell, value in values.items()}, timestamp, self.max_gap)
+        while len(self.balancing_time) < len(series.keys):
+            self.balancing_time.append(0.0)
+
+    def balancing_duty(self, cell):
+        """
+        :return: Share of the observed time the cell was balancing, between 0 and 1
+        """
+        index = self.balancing.index.get(cell)
+        if index is None or not self.balancing.observed:
+            return 0.0
+        return self.balancing_time[index] / self.balancing.observed
+
+    def to_dict(self):
+        cells = {}
+        for index, cell in enumerate(self.voltages.keys):
+            data = self.voltages.to_dict(index)
+            deviation = self.deviations.index.get(cell)
+            if deviation is not None and self.deviations.count[deviation]:
+                data["deviation"] = self.deviations.mean[deviation]
+            cells[cell] = data
+        for cell in self.balancing.keys:
+            cells.setdefault(cell, {"count": 0})["balancing_duty"] = self.balancing_duty(cell)
+
+        spread = self.spread.to_dict(0) if self.spread.keys else {"count": 0}
+        # samples per bucket, not cumulative
+        histogram = {}
+        for bound, count in zip(self.spread_buckets + (math.inf,), self.spread_counts):
+            histogram["+Inf" if bound == math.inf else str(bound)] = count
+        spread["histogram"] = histogram
+
+        return {
+            "cells": cells,
+            "spread": spread,
+            "temperatures": {sensor: self.temperatures.to_dict(index)
+                             for index, sensor in enumerate(self.temperatures.keys)},
+            "observed": self.voltages.observed,
+        }
@@ -0,0 +1,64 @@
+"""
+Request frames and response layouts of the Daly protocol.
+
+Request frames only depend on the address, the command and its extra data, so they get built once and cached.
+The response layouts are precompiled structs, which decode the data directly from the received frame
+with unpack_from instead of parsing a format string and slicing new bytes for every response.
+"""
+import struct
+from functools import lru_cache
+
+SOC = struct.Struct('>h h h h')
+CELL_VOLTAGE_RANGE = struct.Struct('>h b h b 2x')
+TEMPERATURE_RANGE = struct.Struct('>b b b b 4x')
+MOSFET_STATUS = struct.Struct('>b ? ? B l')
+STATUS = struct.Struct('>b b ? ? B h x')
+CELL_VOLTAGES = struct.Struct('>b 3h x')
+TEMPERATURES = struct.Struct('>b 7b')
+
+STATE_NAMES = ("DI1", "DI2", "DI3", "DI4", "DO1", "DO2", "DO3", "DO4")
+
+
+@lru_cache(maxsize=256)
+def request_frame(address, command, extra="", bms_address=1):
+    """
+    Builds a request frame
+
+    :param address: Source address (4 for RS485, 8 for UART/Bluetooth), the upper nibble of the address byte
+    :param command: Command ID ("90" - "98")
+    :param extra: Hex encoded data bytes of the command
+    :param bms_address: Board number of the BMS (1 - 16) that should answer, the lower nibble of the address
+                        byte is the board number - 1. The BMS answers with its board number as address byte.
+                        (Default: 1)
+    :return: Request frame as bytes
+    """
+    # 95 -> a58095080000000000000000c2
+    message = "a5%x%x%s08%s" % (address, bms_address - 1, command, extra)
+    message = message.ljust(24, "0")
+    message_bytes = bytearray.fromhex(message)
+    message_bytes.append(sum(message_bytes) & 0xFF)
+    return bytes(message_bytes)
+
+
+def frame_data(frame):
+    """
+    The 8 data bytes of a response frame, without copying them
+
+    :param frame: Complete response frame
+    :return: memoryview of the data bytes
+    """
+    return memoryview(frame)[4:-1]
+
+
+def decode_states(value):
+    """
+    Decodes the DI/DO state bits of the status response. Like the BMS monitor, only the states up to
+    the highest set bit get returned.
+
+    :param value: State byte
+    :return: Dict of state name -> bool
+    """
+    states = {}
+    for index in range(max(value.bit_length(), 1)):
+        states[STATE_NAMES[index]] = bool(value >> index & 1)
+    return states
@@ -0,0 +1,263 @@
+"""
+A daemon that owns the serial port of a BMS, polls it continuously and answers requests of many clients over a
+Unix domain socket, see DalyBMSDaemon and DalyBMSClient.
+
+The protocol is one JSON object per line in both directions:
+    request:  {"method": "get_soc", "args": [], "max_age": 10}
+    response: {"result": {...}, "timestamp": 1700000000.0, "cached": true} or {"error": "..."}
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from . import stream
+
+# method -> section of the get_all result it can be answered from
+READ_METHODS = {
+    "get_all": None,
+    "get_soc": "soc",
+    "get_cell_voltage_range": "cell_voltage_range",
+    "get_temperature_range": "temperature_range",
+    "get_mosfet_status": "mosfet_status",
+    "get_status": "status",
+    "get_cell_voltages": "cell_voltages",
+    "get_temperatures": "temperatures",
+    "get_balancing_status": "balancing_status",
+    "get_errors": "errors",
+}
+
+WRITE_METHODS = ("set_charge_mosfet", "set_discharge_mosfet", "set_soc", "restart")
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DalyBMSDaemon:
+    """
+    Polls a connected DalyBMS or DalyBMSSinowealth object every 'interval' seconds and keeps the latest get_all
+    result. Clients get answered from it while it is recent enough, otherwise their reads are queued on the bus
+    like the polls, so only one request is on the bus at any time.
+    """
+
+    def __init__(self, bms, socket_path, interval=5, max_age=None, mode=0o660, logger=None):
+        """
+
+        :param bms: Connected DalyBMS or DalyBMSSinowealth object, the daemon is its only user
+        :param socket_path: Path of the Unix domain socket, a stale socket file gets replaced
+        :param interval: Seconds between two polls (Default: 5)
+        :param max_age: Age in seconds up to which requests get answered from the latest poll, clients can
+                        ask for a different age (Default: 2 * interval)
+        :param mode: File permissions of the socket (Default: 0o660)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.bms = bms
+        self.socket_path = socket_path
+        self.interval = interval
+        self.max_age = 2 * interval if max_age is None else max_age
+        self.mode = mode
+        self.latest = None  # (monotonic time, unix timestamp, get_all result)
+        self.bus_lock = threading.RLock()
+        self.server = None
+
+    def _read(self, method, args=()):
+        with self.bus_lock:
+            timestamp = time.time()
+            result = getattr(self.bms, method)(*args)
+            if method == "get_all":
+                self.latest = (time.monotonic(), timestamp, result)
+            elif method in WRITE_METHODS:
+                # the polled values are outdated now
+                self.latest = None
+        return timestamp, result
+
+    def _cached(self, method, max_age):
+        latest = self.latest
+        if latest is None or time.monotonic() - latest[0] > max_age:
+            return None
+        section = READ_METHODS[method]
+        if section is None:
+            return latest[1], latest[2]
+        value = latest[2].get(section)
+        if value is False or value is None:
+            # failed in the last poll, try the BMS again
+            return None
+        return latest[1], value
+
+    def handle(self, request):
+        """
+        :param request: Dict with the method, optional args and max_age
+        :return: Response dict
+        """
+        method = request.get("method")
+        args = request.get("args", [])
+        if method in READ_METHODS:
+            max_age = request.get("max_age")
+            if max_age is None:
+                max_age = self.max_age
+            cached = self._cached(method, max_age)
+            if cached is None:
+                with self.bus_lock:
+                    # another client might have read it while this one was waiting
+                    cached = self._cached(method, max_age)
+                    if cached is None:
+                        timestamp, result = self._read(method)
+                        return {"result": result, "timestamp": timestamp, "cached": False}
+            timestamp, result = cached
+            return {"result": result, "timestamp": timestamp, "cached": True}
+        if method in WRITE_METHODS:
+            timestamp, result = self._read(method, args)
+            return {"result": result, "timestamp": timestamp, "cached": False}
+        return {"error": "unknown method %s" % method}
+
+    def _poll_once(self):
+        try:
+            return self._read("get_all")[1]
+        except Exception as e:
+            # keep polling, e.g. the USB adapter might come back
+            self.logger.error("poll failed: %s", e)
+            return False
+
+    def _poll(self):
+        samples = stream.poll(self._poll_once, self.interval,
+                              metrics=getattr(self.bms, "metrics", None), device=getattr(self.bms, "device", None))
+        for sample in samples:
+            if sample.missed:
+                self.logger.warning("polling takes longer than %s seconds", self.interval)
+
+    def serve_forever(self):
+        """
+        Starts polling in a background thread and serves the clients until shutdown() gets called
+        """
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except Exception as e:
+                        daemon.logger.warning("request %r failed: %s", line, e)
+                        response = {"error": str(e)}
+                    self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        os.chmod(self.socket_path, self.mode)
+        threading.Thread(target=self._poll, daemon=True).start()
+        self.logger.info("serving on %s", self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+
+
+def _int_keys(data):
+    # JSON object keys are strings, but the cell and sensor numbers are ints in the BMS results
+    return {int(key) if key.isdigit() else key: value for key, value in data.items()}
+
+
+class DalyBMSClient:
+    """
+    Has the same get_*, set_* and restart methods as DalyBMS, but asks a DalyBMSDaemon instead of the BMS
+    """
+
+    def __init__(self, max_age=None, timeout=10):
+        """
+
+        :param max_age: Age in seconds up to which the daemon may answer from its latest poll, 0 always
+                        reads from the BMS (Default: the max_age of the daemon)
+        :param timeout: Seconds to wait for the daemon (Default: 10)
+        """
+        self.max_age = max_age
+        self.timeout = timeout
+        self.socket = None
+        self.file = None
+        self.timestamp = None  # of the last result
+
+    def connect(self, socket_path):
+        """
+        :param socket_path: Path of the Unix domain socket of the daemon
+        """
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(socket_path)
+        self.file = self.socket.makefile("rwb")
+
+    def disconnect(self):
+        if self.socket:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+
+    def _call(self, method, *args):
+        request = {"method": method, "args": list(args)}
+        if self.max_age is not None:
+            request["max_age"] = self.max_age
+        self.file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise DaemonError("connection closed by the daemon")
+        response = json.loads(line, object_hook=_int_keys)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        self.timestamp = response["timestamp"]
+        return response["result"]
+
+    def get_soc(self):
+        return self._call("get_soc")
+
+    def get_cell_voltage_range(self):
+        return self._call("get_cell_voltage_range")
+
+    def get_temperature_range(self):
+        return self._call("get_temperature_range")
+
+    def get_mosfet_status(self):
+        return self._call("get_mosfet_status")
+
+    def get_status(self):
+        return self._call("get_status")
+
+    def get_cell_voltages(self):
+        return self._call("get_cell_voltages")
+
+    def get_temperatures(self):
+        return self._call("get_temperatures")
+
+    def get_balancing_status(self):
+        return self._call("get_balancing_status")
+
+    def get_errors(self):
+        return self._call("get_errors")
+
+    def get_all(self):
+        return self._call("get_all")
+
+    def set_charge_mosfet(self, on=True):
+        return self._call("set_charge_mosfet", on)
+
+    def set_discharge_mosfet(self, on=True):
+        return self._call("set_discharge_mosfet", on)
+
+    def set_soc(self, value):
+        return self._call("set_soc", value)
+
+    def restart(self):
+        return self._call("restart")
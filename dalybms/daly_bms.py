@@ -1,19 +1,60 @@
 import serial
-import struct
 import time
 import math
 import logging
 
-from .error_codes import ERROR_CODES
+from . import codec, records, stream
+from .alarms import DALY_ALARMS
+from .cache import ResponseCache
+from .frame_parser import DalyFrameParser
+from .retry_policy import polling_cycle
 
 
 class DalyBMS:
-    def __init__(self, request_retries=3, address=4, logger=None):
+    # command ID -> seconds a response gets cached. Empty by default, every frame carries live values, e.g. the
+    # status next to the cell and sensor count the charger and load state and the cycles. The counts needed to
+    # read the cell voltages and temperatures are kept from the last get_status anyway.
+    CACHE_TTLS = {}
+
+    # command ID -> commands whose cached responses are outdated after it got sent
+    INVALIDATES = {
+        "d9": ("93",),
+        "da": ("93",),
+        "21": ("90", "93"),
+    }
+
+    # decoder of the error mask, see get_error_mask and alarms.AlarmTracker
+    ALARMS = DALY_ALARMS
+
+    # field of get_snapshot -> command ID
+    SNAPSHOT_FIELDS = {
+        "soc": "90",
+        "cell_voltage_range": "91",
+        "temperature_range": "92",
+        "mosfet_status": "93",
+        "status": "94",
+        "cell_voltages": "95",
+        "temperatures": "96",
+        "balancing_status": "97",
+        "errors": "98",
+    }
+
+    def __init__(self, request_retries=3, address=4, logger=None, frame_gap_timeout=0.05, history=None,
+                 capture=None, metrics=None, retry_policy=None, cache_ttls=None):
         """
 
         :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
         :param address: Source address for commands sent to the BMS (4 for RS485, 8 for UART/Bluetooth)
         :param logger: Python Logger object for output (Default: None)
+        :param frame_gap_timeout: Seconds of silence after a response frame after which no further frames
+                                  are expected (Default: 0.05)
+        :param history: History object that keeps the results of get_all and get_snapshot (Default: None)
+        :param capture: CaptureWriter object that records all request and response frames (Default: None)
+        :param metrics: Metrics object that counts requests, retries and frame errors (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for learned timeouts and retry backoff
+                             (Default: None, fixed timeouts and a delay of 0.2 seconds between retries)
+        :param cache_ttls: Dict of command ID -> seconds a response gets reused, {} disables the cache
+                           (Default: CACHE_TTLS)
         """
         self.status = None
         if logger:
@@ -22,6 +63,16 @@ class DalyBMS:
             self.logger = logging.getLogger(__name__)
         self.request_retries = request_retries
         self.address = address  # 4 = USB, 8 = Bluetooth
+        # via UART/Bluetooth the BMS returns all frames of the cell voltages and temperatures, even empty ones
+        self.sends_empty_frames = address == 8
+        self.frame_gap_timeout = frame_gap_timeout
+        self.history = history
+        self.capture = capture
+        self.metrics = metrics
+        self.retry_policy = retry_policy
+        self.cache = ResponseCache(self.CACHE_TTLS if cache_ttls is None else cache_ttls)
+        self.device = None
+        self.corrupt_responses = set()  # commands whose response failed the checksum in the last read
 
     def connect(self, device):
         """
@@ -29,6 +80,7 @@ class DalyBMS:
 
         :param device: Serial device, e.g. /dev/ttyUSB0
         """
+        self.device = device
         self.serial = serial.Serial(
             port=device,
             baudrate=9600,
@@ -62,12 +114,9 @@ class DalyBMS:
         :param command: Command ID ("90" - "98")
         :return: Request message as bytes
         """
-        # 95 -> a58095080000000000000000c2
-        message = "a5%i0%s08%s" % (self.address, command, extra)
-        message = message.ljust(24, "0")
-        message_bytes = bytearray.fromhex(message)
-        message_bytes += self._calc_crc(message_bytes)
-        self.logger.debug("w %s" % message_bytes.hex())
+        message_bytes = codec.request_frame(self.address, command, extra)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("w %s", message_bytes.hex())
         return message_bytes
 
     def _read_request(self, command, extra="", max_responses=1, return_list=False):
@@ -78,9 +127,16 @@ class DalyBMS:
         :param max_responses: For how many response packages it should wait (Default: 1).
         :return: Request message as bytes or False
         """
+        cached = self._cached_response(command, return_list)
+        if cached is not None:
+            return cached
+        if self._cycle_abandoned(command):
+            return False
         response_data = None
         x = None
-        for x in range(0, self.request_retries):
+        tries = self._request_tries()
+        start = time.monotonic()
+        for x in range(0, tries):
             response_data = self._read(
                 command=command,
                 extra=extra,
@@ -88,15 +144,97 @@ class DalyBMS:
                 return_list=return_list)
             if not response_data:
                 self.logger.debug("%x. try failed, retrying..." % (x + 1))
-                time.sleep(0.2)
+                if command not in self.corrupt_responses:
+                    # the BMS did answer in case of a corrupted response, so it gets asked again right away
+                    time.sleep(self._retry_delay(x + 1, tries))
             else:
                 break
+        self._request_done(command, start, x + 1, response_data)
         if not response_data:
             self.logger.error('%s failed after %s tries' % (command, x + 1))
             return False
         return response_data
 
-    def _read(self, command, extra="", max_responses=1, return_list=False):
+    def _request_done(self, command, start, tries, response_data):
+        """
+        Updates the metrics and the retry policy after a request
+
+        :param start: time.monotonic() before the first try
+        :param tries: Number of tries
+        """
+        if self.metrics:
+            self.metrics.request(self.device, command, time.monotonic() - start, tries, bool(response_data))
+        if self.retry_policy:
+            if response_data:
+                self.retry_policy.success()
+            else:
+                self.retry_policy.failure()
+        if response_data:
+            self.cache.put(command, response_data if isinstance(response_data, list) else [response_data])
+        if command in self.INVALIDATES:
+            self.cache.invalidate(*self.INVALIDATES[command])
+
+    def fresh(self):
+        """
+        Context manager in which all requests go to the BMS instead of the cache
+
+            with bms.fresh():
+                status = bms.get_status()
+        """
+        return self.cache.fresh()
+
+    def invalidate(self, *commands):
+        """
+        Drops cached responses
+
+        :param commands: Command IDs ("90" - "98"), all if none are given
+        """
+        self.cache.invalidate(*commands)
+
+    def _cached_response(self, command, return_list=False):
+        """
+        :return: Cached response data in the same form as _read returns it, or None
+        """
+        frames = self.cache.get(command)
+        if frames is None:
+            return None
+        self.logger.debug("%s from cache", command)
+        if return_list or len(frames) > 1:
+            return frames
+        return frames[0]
+
+    def _cycle_abandoned(self, command):
+        if self.retry_policy and self.retry_policy.abandoned:
+            self.logger.debug("skipping %s, the BMS does not respond", command)
+            return True
+        return False
+
+    def _request_tries(self):
+        if self.retry_policy:
+            return self.retry_policy.tries(self.request_retries)
+        return self.request_retries
+
+    def _retry_delay(self, failures, tries):
+        """
+        :param failures: Failed tries of the current request so far
+        :param tries: Number of tries of the current request
+        :return: Seconds to wait after a failed try
+        """
+        if not self.retry_policy:
+            return 0.2
+        if failures >= tries:
+            return 0
+        return self.retry_policy.delay(failures)
+
+    def _first_frame_timeout(self, command, default):
+        """
+        :return: Timeout for the first response frame to a command, None keeps the default
+        """
+        if self.retry_policy:
+            return self.retry_policy.timeout(command, default)
+        return None
+
+    def _read(self, command, extra="", max_responses=1, return_list=False, timeout=None):
         self.logger.debug("-- %s ------------------------" % command)
         if not self.serial.is_open:
             self.serial.open()
@@ -109,27 +247,15 @@ class DalyBMS:
         if not self.serial.write(message_bytes):
             self.logger.error("serial write failed for command" % command)
             return False
-        x = 0
-        response_data = []
-        while True:
-            b = self.serial.read(13)
-            if len(b) == 0:
-                self.logger.debug("%i empty response for command %s" % (x, command))
-                break
-            self.logger.debug("%i %s %s" % (x, b.hex(), len(b)))
-            x += 1
-            response_crc = self._calc_crc(b[:-1])
-            if response_crc != b[-1:]:
-                self.logger.debug("response crc mismatch: %s != %s" % (response_crc.hex(), b[-1:].hex()))
-            header = b[0:4].hex()
-            # todo: verify  more header fields
-            if header[4:6] != command:
-                self.logger.debug("invalid header %s: wrong command (%s != %s)" % (header, header[4:6], command))
-                continue
-            data = b[4:-1]
-            response_data.append(data)
-            if x == max_responses:
-                break
+        if self.capture:
+            self.capture.write_requests(message_bytes)
+
+        if timeout is None:
+            timeout = self._first_frame_timeout(command, self.serial.timeout)
+        response_data = self._receive({command: max_responses}, timeout=timeout)[command]
+        if command in self.corrupt_responses:
+            # the frames of a response have to be complete, it gets requested again right away
+            return False
 
         if return_list or len(response_data) > 1:
             return response_data
@@ -138,6 +264,184 @@ class DalyBMS:
         else:
             return False
 
+    def _read_pipeline(self, requests):
+        """
+        Sends several read requests at once and sorts the responses by the command byte in their header.
+
+        :param requests: Dict of command ID -> number of expected response frames
+        :return: Dict of command ID -> list of received response data, may be incomplete
+        """
+        self.logger.debug("-- pipeline %s ------------------------" % " ".join(requests))
+        if not self.serial.is_open:
+            self.serial.open()
+        message_bytes = bytearray()
+        for command in requests:
+            message_bytes += self._format_message(command)
+
+        # clear all buffers, in case something is left from a previous command that failed
+        self.serial.reset_input_buffer()
+        self.serial.reset_output_buffer()
+
+        if not self.serial.write(message_bytes):
+            self.logger.error("serial write failed for pipeline %s" % " ".join(requests))
+            return {command: [] for command in requests}
+        if self.capture:
+            self.capture.write_requests(message_bytes)
+
+        timeout = self._first_frame_timeout(next(iter(requests)), self.serial.timeout)
+        return self._receive(requests, timeout=timeout)
+
+    def _drain(self):
+        """
+        Drops the bytes that are still arriving, until the line is quiet for frame_gap_timeout,
+        but at most for the port timeout
+        """
+        port_timeout = self.serial.timeout
+        self.serial.timeout = self.frame_gap_timeout
+        end = time.monotonic() + port_timeout
+        dropped = 0
+        try:
+            while time.monotonic() < end:
+                b = self.serial.read(max(self.serial.in_waiting, 1))
+                if not b:
+                    break
+                dropped += len(b)
+        finally:
+            self.serial.timeout = port_timeout
+        if dropped:
+            self.logger.debug("dropped %i late bytes", dropped)
+
+    def _receive(self, requests, timeout=None):
+        """
+        Reads response frames until all expected frames have arrived. Every command gets the port timeout
+        (or 'timeout') for its first frame, between the frames of a multi frame response only frame_gap_timeout.
+        A frame that fails the checksum counts as arrived, so the read doesn't wait for it until the timeout,
+        see corrupt_responses.
+
+        :param requests: Dict of command ID -> number of expected response frames
+        :param timeout: Timeout in seconds for the first frame (Default: serial port timeout)
+        :return: Dict of command ID -> list of received response data, may be incomplete
+        """
+        responses = {command: [] for command in requests}
+        missing = sum(requests.values())
+        parser = DalyFrameParser(logger=self.logger)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        port_timeout = self.serial.timeout
+        first_timeout = port_timeout if timeout is None else timeout
+        self.serial.timeout = first_timeout
+        start = time.monotonic()
+        x = 0
+        corrupt = {}
+        current = None  # command whose response is coming in
+        try:
+            while missing > 0:
+                b = self.serial.read(max(self.serial.in_waiting, parser.bytes_needed))
+                if len(b) == 0:
+                    if current is not None and self._awaiting_first_frame(requests, responses, corrupt):
+                        # the rest of a multi frame response got lost, the next command may still answer
+                        current = None
+                        self.serial.timeout = first_timeout
+                        continue
+                    self.logger.debug("%i empty response, %i frames missing", x, missing)
+                    break
+                for frame in parser.feed(b):
+                    if debug:
+                        self.logger.debug("%i %s", x, frame.hex())
+                    if self.capture:
+                        self.capture.write_response(frame)
+                    if self._sort_frame(frame, requests, responses):
+                        if x == 0:
+                            self._record_latency(frame, requests, time.monotonic() - start)
+                        x += 1
+                        missing -= 1
+                        current = "%02x" % frame[2]
+                if parser.corrupt_commands:
+                    command = "%02x" % parser.corrupt_commands[-1]
+                    missing -= self._count_corrupt(parser, requests, responses, corrupt)
+                    if command in requests:
+                        current = command
+                self.serial.timeout = self._next_frame_timeout(current, requests, responses, corrupt,
+                                                               first_timeout)
+        finally:
+            self.serial.timeout = port_timeout
+        self.corrupt_responses = set(corrupt)
+        if self.metrics:
+            self.metrics.receive(self.device, parser, requests, responses)
+        return responses
+
+    def _next_frame_timeout(self, current, requests, responses, corrupt, first_timeout):
+        """
+        :param current: Command ID of the last expected frame, or None
+        :return: frame_gap_timeout while the response of 'current' is incomplete, otherwise the first frame
+                 timeout, as the next command of a pipeline takes as long to answer as the first one
+        """
+        if current is not None and len(responses[current]) + corrupt.get(current, 0) < requests[current]:
+            return self.frame_gap_timeout
+        return first_timeout
+
+    @staticmethod
+    def _awaiting_first_frame(requests, responses, corrupt):
+        """
+        :return: True if a command has not sent any frame yet
+        """
+        return any(expected and not responses[command] and command not in corrupt
+                   for command, expected in requests.items())
+
+    def _count_corrupt(self, parser, requests, responses, corrupt):
+        """
+        Counts the frames of requested commands the parser dropped because of a checksum mismatch
+
+        :param corrupt: Dict of command ID -> number of corrupt frames so far, gets updated
+        :return: Number of expected frames that arrived corrupt
+        """
+        count = 0
+        for command_byte in parser.corrupt_commands:
+            command = "%02x" % command_byte
+            if command not in requests:
+                continue
+            if len(responses[command]) + corrupt.get(command, 0) < requests[command]:
+                count += 1
+            corrupt[command] = corrupt.get(command, 0) + 1
+        parser.corrupt_commands.clear()
+        return count
+
+    def _record_latency(self, frame, requests, latency):
+        if self.retry_policy:
+            command = "%02x" % frame[2]
+            if command in requests:
+                self.retry_policy.record(command, latency)
+
+    def _sort_frame(self, frame, requests, responses):
+        """
+        Adds the data of a response frame to the responses of its command
+
+        :return: True if the frame was expected
+        """
+        command = "%02x" % frame[2]
+        # todo: verify  more header fields
+        if command not in responses:
+            self.logger.debug("invalid header %s: unexpected command %s", frame[0:4].hex(), command)
+            return False
+        if len(responses[command]) >= requests[command]:
+            self.logger.debug("skipping surplus response for %s", command)
+            return False
+        responses[command].append(codec.frame_data(frame))
+        return True
+
+    def _expected_responses(self, command):
+        """
+        Number of response frames the BMS sends for a read command.
+        Multi frame commands depend on the cell and sensor count of the last get_status call.
+
+        :param command: Command ID ("90" - "98")
+        :return: Number of response frames or False if the status is unknown
+        """
+        if command == "95":
+            return self._calc_num_responses(status_field="cells", num_per_frame=3)
+        elif command == "96":
+            return self._calc_num_responses(status_field="temperature_sensors", num_per_frame=7)
+        return 1
+
     def get_soc(self, response_data=None):
         # SOC of Total Voltage Current
         if not response_data:
@@ -145,14 +449,7 @@ class DalyBMS:
         if not response_data:
             return False
 
-        parts = struct.unpack('>h h h h', response_data)
-        data = {
-            "total_voltage": parts[0] / 10,
-            # "x_voltage": parts[1] / 10, # always 0
-            "current": (parts[2] - 30000) / 10,  # negative=charging, positive=discharging
-            "soc_percent": parts[3] / 10
-        }
-        return data
+        return records.Soc.from_response(response_data).to_dict()
 
     def get_cell_voltage_range(self, response_data=None):
         # Cells with the maximum and minimum voltage
@@ -161,14 +458,7 @@ class DalyBMS:
         if not response_data:
             return False
 
-        parts = struct.unpack('>h b h b 2x', response_data)
-        data = {
-            "highest_voltage": parts[0] / 1000,
-            "highest_cell": parts[1],
-            "lowest_voltage": parts[2] / 1000,
-            "lowest_cell": parts[3],
-        }
-        return data
+        return records.CellVoltageRange.from_response(response_data).to_dict()
 
     def get_temperature_range(self, response_data=None):
         # Temperature in degrees celsius
@@ -176,14 +466,7 @@ class DalyBMS:
             response_data = self._read_request("92")
         if not response_data:
             return False
-        parts = struct.unpack('>b b b b 4x', response_data)
-        data = {
-            "highest_temperature": parts[0] - 40,
-            "highest_sensor": parts[1],
-            "lowest_temperature": parts[2] - 40,
-            "lowest_sensor": parts[3],
-        }
-        return data
+        return records.TemperatureRange.from_response(response_data).to_dict()
 
     def get_mosfet_status(self, response_data=None):
         # Charge/discharge, MOS status
@@ -192,26 +475,10 @@ class DalyBMS:
         if not response_data:
             return False
         # todo: implement
-        self.logger.debug(response_data.hex())
-
-        parts = struct.unpack('>b ? ? B l', response_data)
-
-        if parts[0] == 0:
-            mode = "stationary"
-        elif parts[0] == 1:
-            mode = "charging"
-        else:
-            mode = "discharging"
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(response_data.hex())
 
-        data = {
-            "mode": mode,
-            "charging_mosfet": parts[1],
-            "discharging_mosfet": parts[2],
-            # "bms_cycles": parts[3], unstable result
-            "capacity_ah": parts[4] / 1000,
-        }
-
-        return data
+        return records.MosfetStatus.from_response(response_data).to_dict()
 
     def get_status(self, response_data=None):
         if not response_data:
@@ -219,25 +486,7 @@ class DalyBMS:
         if not response_data:
             return False
 
-        parts = struct.unpack('>b b ? ? b h x', response_data)
-        state_bits = bin(parts[4])[2:]
-        state_names = ["DI1", "DI2", "DI3", "DI4", "DO1", "DO2", "DO3", "DO4"]
-        states = {}
-        state_index = 0
-        for bit in reversed(state_bits):
-            if len(state_bits) == state_index:
-                break
-            states[state_names[state_index]] = bool(int(bit))
-            state_index += 1
-        data = {
-            "cells": parts[0],  # number of cells
-            "temperature_sensors": parts[1],  # number of sensors
-            "charger_running": parts[2],
-            "load_running": parts[3],
-            # "state_bits": state_bits,
-            "states": states,
-            "cycles": parts[5],  # number of charge/discharge cycles
-        }
+        data = records.Status.from_response(response_data).to_dict()
         self.status = data
         return data
 
@@ -247,11 +496,10 @@ class DalyBMS:
             return False
 
         # each response message includes 3 cell voltages
-        if self.address == 8:
-            # via Bluetooth the BMS returns all frames, even when they don't have data
-            if status_field == 'cell_voltages':
+        if self.sends_empty_frames:
+            if status_field == 'cells':
                 max_responses = 16
-            elif status_field == 'temperatures':
+            elif status_field == 'temperature_sensors':
                 max_responses = 3
             else:
                 self.logger.error("unkonwn status_field %s" % status_field)
@@ -262,48 +510,59 @@ class DalyBMS:
         return max_responses
 
     def _split_frames(self, response_data, status_field, structure):
-        values = {}
+        """
+        Joins the values of numbered response frames
+
+        :return: List of raw values, stops at the first missing frame
+        """
+        count = self.status[status_field]
+        values = []
         x = 1
         for response_bytes in response_data:
-            parts = struct.unpack(structure, response_bytes)
+            parts = structure.unpack_from(response_bytes)
             if parts[0] != x:
-                self.logger.warning("frame out of order, expected %i, got %i" % (x, response_bytes[0]))
+                self.logger.warning("frame out of order, expected %i, got %i", x, parts[0])
+                if self.metrics:
+                    self.metrics.count("dalybms_out_of_order_frames_total", self.device,
+                                       "95" if status_field == "cells" else "96")
                 continue
-            for value in parts[1:]:
-                values[len(values) + 1] = value
-                if len(values) == self.status[status_field]:
-                    return values
+            values.extend(parts[1:])
+            if len(values) >= count:
+                return values[:count]
             x += 1
+        return values
 
     def get_cell_voltages(self, response_data=None):
         if not response_data:
-            max_responses = self._calc_num_responses(status_field="cells", num_per_frame=3)
+            max_responses = self._expected_responses("95")
             if not max_responses:
                 return
             response_data = self._read_request("95", max_responses=max_responses, return_list=True)
         if not response_data:
             return False
 
-        cell_voltages = self._split_frames(response_data=response_data, status_field="cells", structure=">b 3h x")
-        for id in cell_voltages:
-            cell_voltages[id] = cell_voltages[id] / 1000
-        return cell_voltages
+        return self._parse_cell_voltages(response_data).to_dict()
+
+    def _parse_cell_voltages(self, response_data):
+        return records.CellVoltages(
+            self._split_frames(response_data=response_data, status_field="cells", structure=codec.CELL_VOLTAGES))
 
     def get_temperatures(self, response_data=None):
         # Sensor temperatures
         if not response_data:
-            max_responses = self._calc_num_responses(status_field="temperature_sensors", num_per_frame=7)
+            max_responses = self._expected_responses("96")
             if not max_responses:
                 return
             response_data = self._read_request("96", max_responses=max_responses, return_list=True)
         if not response_data:
             return False
 
-        temperatures = self._split_frames(response_data=response_data, status_field="temperature_sensors",
-                                          structure=">b 7b")
-        for id in temperatures:
-            temperatures[id] = temperatures[id] - 40
-        return temperatures
+        return self._parse_temperatures(response_data).to_dict()
+
+    def _parse_temperatures(self, response_data):
+        return records.Temperatures(
+            self._split_frames(response_data=response_data, status_field="temperature_sensors",
+                               structure=codec.TEMPERATURES))
 
     def get_balancing_status(self, response_data=None):
         # Cell balancing status
@@ -311,54 +570,181 @@ class DalyBMS:
             response_data = self._read_request("97")
         if not response_data:
             return False
-        self.logger.info(response_data.hex())
-        bits = bin(int(response_data.hex(), base=16))[2:].zfill(48)
-        self.logger.info(bits)
-        cells = {}
-        for cell in range(1, self.status["cells"] + 1):
-            cells[cell] = bool(int(bits[cell * -1]))
-        self.logger.info(cells)
-        # todo: get sample data and verify result
-        return {"error": "not implemented"}
+        balancing_status = self._parse_balancing_status(response_data)
+        if not balancing_status:
+            return False
+        return balancing_status.to_dict()
+
+    def _parse_balancing_status(self, response_data):
+        if not self.status:
+            self.logger.error("get_status has to be called at least once before calling get_balancing_status")
+            return False
+        return records.BalancingStatus.from_response(response_data, self.status["cells"])
 
     def get_errors(self, response_data=None):
         # Battery failure status
         if not response_data:
             response_data = self._read_request("98")
-        if int.from_bytes(response_data, byteorder='big') == 0:
-            return []
-
-        byte_index = 0
-        errors = []
-        for b in response_data:
-            if b == 0:
-                byte_index += 1
-                continue
-            bits = bin(b)[2:]
-            bit_index = 0
-            for bit in reversed(bits):
-                if bit == "1":
-                    errors.append(ERROR_CODES[byte_index][bit_index])
-
-                bit_index += 1
+        if not response_data:
+            return False
+        return records.Errors.from_response(response_data).to_list()
 
-            self.logger.debug("%s %s %s" % (byte_index, b, bits))
-            byte_index += 1
-        return errors
+    def get_error_mask(self, response_data=None):
+        """
+        :return: Battery failure status as int, bit 0 of the first byte is bit 0, or False
+        """
+        if not response_data:
+            response_data = self._read_request("98")
+        if not response_data:
+            return False
+        return records.Errors.from_response(response_data).mask
 
     def get_all(self):
-        return {
-            "soc": self.get_soc(),
-            "cell_voltage_range": self.get_cell_voltage_range(),
-            "temperature_range": self.get_temperature_range(),
-            "mosfet_status": self.get_mosfet_status(),
-            "status": self.get_status(),
-            "cell_voltages": self.get_cell_voltages(),
-            "temperatures": self.get_temperatures(),
-            "balancing_status": self.get_balancing_status(),
-            "errors": self.get_errors()
-        }
+        with polling_cycle(self.retry_policy):
+            data = {
+                "soc": self.get_soc(),
+                "cell_voltage_range": self.get_cell_voltage_range(),
+                "temperature_range": self.get_temperature_range(),
+                "mosfet_status": self.get_mosfet_status(),
+                "status": self.get_status(),
+                "cell_voltages": self.get_cell_voltages(),
+                "temperatures": self.get_temperatures(),
+                "balancing_status": self.get_balancing_status(),
+                "errors": self.get_errors()
+            }
+            if self.history:
+                self.history.add(data)
+            return data
     
+    def get_all_pipelined(self):
+        """
+        Same result as get_all, but all requests get sent at once and only the commands
+        with missing responses get repeated.
+        """
+        return self.get_snapshot().to_dict()
+
+    def get_snapshot(self, fields=None):
+        """
+        Reads the same data as get_all_pipelined, but returns compact records instead of nested dicts
+
+        :param fields: Names of the fields to read, see SNAPSHOT_FIELDS, the others stay False (Default: all)
+        :return: records.Snapshot
+        """
+        with polling_cycle(self.retry_policy):
+            if not self.status:
+                self.get_status()
+            start = time.monotonic()
+            requests = self._snapshot_requests(fields)
+            responses = self._cached_responses(requests)
+            pending = {command: expected for command, expected in requests.items() if command not in responses}
+            if pending:
+                received = self._read_pipeline(pending)
+                self._pipeline_done(pending, received)
+                responses.update(received)
+            incomplete = [command for command, expected in requests.items() if len(responses[command]) < expected]
+            if pending and incomplete:
+                # late replies to the pipeline must not be taken for the replies to the repeated requests
+                self._drain()
+            for command in incomplete:
+                expected = requests[command]
+                # multi frame responses have to be complete and in order, so the whole command gets repeated
+                self.logger.debug("%s: got %i of %i responses, retrying", command, len(responses[command]),
+                                  expected)
+                responses[command] = self._read_request(command, max_responses=expected, return_list=True) or []
+            if self.metrics:
+                # the commands that had to be repeated are also counted on their own
+                self.metrics.request(self.device, "snapshot", time.monotonic() - start, 1,
+                                     all(len(responses[c]) >= e for c, e in requests.items()))
+            snapshot = self._parse_snapshot(responses)
+            if self.history:
+                self.history.add(snapshot)
+            return snapshot
+
+    def _cached_responses(self, requests):
+        """
+        :return: Dict of command ID -> list of cached response data, for the commands that are cached
+        """
+        responses = {}
+        for command in requests:
+            frames = self._cached_response(command, return_list=True)
+            if frames is not None:
+                responses[command] = frames
+        return responses
+
+    def _pipeline_done(self, requests, responses):
+        """
+        Updates the retry policy and the cache after a pipelined read
+        """
+        if self.retry_policy:
+            if any(responses.values()):
+                self.retry_policy.success()
+            else:
+                self.retry_policy.failure()
+        for command, expected in requests.items():
+            if responses[command] and len(responses[command]) >= expected:
+                self.cache.put(command, responses[command])
+
+    def _snapshot_requests(self, fields=None):
+        if fields is None:
+            commands = self.SNAPSHOT_FIELDS.values()
+        else:
+            commands = [self._snapshot_command(field) for field in fields]
+        requests = {}
+        for command in commands:
+            requests[command] = self._expected_responses(command) or 0
+        return requests
+
+    def _snapshot_command(self, field):
+        try:
+            return self.SNAPSHOT_FIELDS[field]
+        except KeyError:
+            raise ValueError("unknown field %s, use one of %s" % (field, ", ".join(self.SNAPSHOT_FIELDS)))
+
+    def _parse_snapshot(self, responses):
+        """
+        Parses the responses of a pipelined snapshot, see get_snapshot
+
+        :param responses: Dict of command ID -> list of response data, unrequested commands can be missing
+        :return: records.Snapshot, with False for every command without response
+        """
+        snapshot = records.Snapshot()
+        for key, command, record in (("soc", "90", records.Soc),
+                                     ("cell_voltage_range", "91", records.CellVoltageRange),
+                                     ("temperature_range", "92", records.TemperatureRange),
+                                     ("mosfet_status", "93", records.MosfetStatus),
+                                     ("status", "94", records.Status),
+                                     ("errors", "98", records.Errors)):
+            if responses.get(command):
+                setattr(snapshot, key, record.from_response(responses[command][0]))
+
+        if snapshot.status:
+            self.status = snapshot.status.to_dict()
+        if responses.get("95"):
+            snapshot.cell_voltages = self._parse_cell_voltages(responses["95"])
+        if responses.get("96"):
+            snapshot.temperatures = self._parse_temperatures(responses["96"])
+        if responses.get("97"):
+            snapshot.balancing_status = self._parse_balancing_status(responses["97"][0])
+        return snapshot
+
+    def stream(self, interval=1, fields=None):
+        """
+        Reads snapshots on fixed deadlines, e.g.
+
+            for sample in bms.stream(interval=2, fields=("soc", "cell_voltages")):
+                print(sample.timestamp, sample.data.soc.current)
+
+        :param interval: Seconds between the start of two reads (Default: 1)
+        :param fields: Names of the fields to read, see SNAPSHOT_FIELDS (Default: all)
+        :return: Generator of stream.Sample objects, Sample.data is a records.Snapshot
+        """
+        if fields is not None:
+            fields = tuple(fields)
+            for field in fields:
+                # fail before the first read instead of on it
+                self._snapshot_command(field)
+        return stream.poll(lambda: self.get_snapshot(fields), interval, metrics=self.metrics, device=self.device)
+
     def set_charge_mosfet(self, on=True, response_data=None):
         if on:
             extra = "01"
@@ -400,4 +786,6 @@ class DalyBMS:
         self.logger.info(response_data.hex())
 
     def restart(self, response_data=None):
-        response_data = self._read("00","",1,False)
\ No newline at end of file
+        self.cache.invalidate()
+        # the BMS doesn't reliably answer before it restarts, so don't wait for the full port timeout
+        response_data = self._read("00", timeout=self.frame_gap_timeout)
\ No newline at end of file
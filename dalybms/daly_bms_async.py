@@ -0,0 +1,640 @@
+import asyncio
+import serial
+import time
+import logging
+
+from . import stream
+from .daly_bms import DalyBMS
+from .daly_sinowealth import DalyBMSSinowealth
+from .frame_parser import DalyFrameParser
+from .retry_policy import polling_cycle
+
+
+class AsyncSerialTransport:
+    """
+    Non-blocking serial port that gets read by the asyncio event loop instead of a thread.
+    Relies on loop.add_reader, so it needs a POSIX system.
+    """
+
+    def __init__(self, device, baudrate=9600, logger=None):
+        """
+
+        :param device: Serial device, e.g. /dev/ttyUSB0
+        :param baudrate: Baud rate of the serial device (Default: 9600)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.device = device
+        self.baudrate = baudrate
+        self.serial = None
+        self._loop = None
+        self._buffer = bytearray()
+        self._waiter = None
+
+    def open(self):
+        """
+        Opens the port, has to be called from within the running event loop
+        """
+        self.serial = serial.Serial(
+            port=self.device,
+            baudrate=self.baudrate,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=0,
+            xonxoff=False,
+            writeTimeout=0
+        )
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.serial.fileno(), self._on_readable)
+
+    def close(self):
+        if self.serial and self.serial.is_open:
+            self._loop.remove_reader(self.serial.fileno())
+            self.serial.close()
+
+    @property
+    def is_open(self):
+        return self.serial is not None and self.serial.is_open
+
+    def _on_readable(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except serial.SerialException as e:
+            self.logger.error("serial read failed: %s" % e)
+            return
+        if not data:
+            return
+        self._buffer += data
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def reset_input_buffer(self):
+        self.serial.reset_input_buffer()
+        self._buffer.clear()
+
+    def write(self, data):
+        return self.serial.write(data)
+
+    async def read(self, size, timeout):
+        """
+        Waits until data is available and returns up to 'size' bytes
+
+        :param size: Maximum number of bytes
+        :param timeout: Seconds to wait for data
+        :return: Received bytes, empty in case of a timeout
+        """
+        if not self._buffer:
+            self._waiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                return b""
+            finally:
+                self._waiter = None
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+
+class AsyncDalyBMS(DalyBMS):
+    def __init__(self, request_retries=3, address=4, logger=None, frame_gap_timeout=0.05, timeout=0.5,
+                 history=None, capture=None, metrics=None, retry_policy=None, cache_ttls=None):
+        """
+
+        :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
+        :param address: Source address for commands sent to the BMS (4 for RS485, 8 for UART)
+        :param logger: Python Logger object for output (Default: None)
+        :param frame_gap_timeout: Seconds of silence after a response frame after which no further frames
+                                  are expected (Default: 0.05)
+        :param timeout: Seconds to wait for the first response frame (Default: 0.5)
+        :param history: History object that keeps the results of get_all and get_snapshot (Default: None)
+        :param capture: CaptureWriter object that records all request and response frames (Default: None)
+        :param metrics: Metrics object that counts requests, retries and frame errors (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for learned timeouts and retry backoff (Default: None)
+        :param cache_ttls: Dict of command ID -> seconds a response gets reused, {} disables the cache
+                           (Default: CACHE_TTLS)
+        """
+        DalyBMS.__init__(self, request_retries=request_retries, address=address, logger=logger,
+                         frame_gap_timeout=frame_gap_timeout, history=history, capture=capture, metrics=metrics,
+                         retry_policy=retry_policy, cache_ttls=cache_ttls)
+        self.timeout = timeout
+        self.transport = None
+
+    async def connect(self, device):
+        """
+        Connect to a serial device
+
+        :param device: Serial device, e.g. /dev/ttyUSB0
+        """
+        self.device = device
+        self.transport = AsyncSerialTransport(device, logger=self.logger)
+        self.transport.open()
+        await self.get_status()
+
+    async def disconnect(self):
+        if self.transport:
+            self.transport.close()
+
+    async def _read_request(self, command, extra="", max_responses=1, return_list=False):
+        cached = self._cached_response(command, return_list)
+        if cached is not None:
+            return cached
+        if self._cycle_abandoned(command):
+            return False
+        response_data = None
+        x = None
+        tries = self._request_tries()
+        start = time.monotonic()
+        for x in range(0, tries):
+            response_data = await self._read(
+                command=command,
+                extra=extra,
+                max_responses=max_responses,
+                return_list=return_list)
+            if not response_data:
+                self.logger.debug("%x. try failed, retrying..." % (x + 1))
+                if command not in self.corrupt_responses:
+                    await asyncio.sleep(self._retry_delay(x + 1, tries))
+            else:
+                break
+        self._request_done(command, start, x + 1, response_data)
+        if not response_data:
+            self.logger.error('%s failed after %s tries' % (command, x + 1))
+            return False
+        return response_data
+
+    async def _read(self, command, extra="", max_responses=1, return_list=False, timeout=None):
+        self.logger.debug("-- %s ------------------------" % command)
+        message_bytes = self._format_message(command, extra=extra)
+
+        # clear the buffer, in case something is left from a previous command that failed
+        self.transport.reset_input_buffer()
+
+        if not self.transport.write(message_bytes):
+            self.logger.error("serial write failed for command %s" % command)
+            return False
+        if self.capture:
+            self.capture.write_requests(message_bytes)
+
+        if timeout is None:
+            timeout = self._first_frame_timeout(command, self.timeout)
+        response_data = (await self._receive({command: max_responses}, timeout=timeout))[command]
+        if command in self.corrupt_responses:
+            return False
+
+        if return_list or len(response_data) > 1:
+            return response_data
+        elif len(response_data) == 1:
+            return response_data[0]
+        else:
+            return False
+
+    async def _read_pipeline(self, requests):
+        self.logger.debug("-- pipeline %s ------------------------" % " ".join(requests))
+        message_bytes = bytearray()
+        for command in requests:
+            message_bytes += self._format_message(command)
+
+        self.transport.reset_input_buffer()
+
+        if not self.transport.write(message_bytes):
+            self.logger.error("serial write failed for pipeline %s" % " ".join(requests))
+            return {command: [] for command in requests}
+        if self.capture:
+            self.capture.write_requests(message_bytes)
+
+        return await self._receive(requests, timeout=self._first_frame_timeout(next(iter(requests)), self.timeout))
+
+    async def _drain(self):
+        end = time.monotonic() + self.timeout
+        dropped = 0
+        while time.monotonic() < end:
+            b = await self.transport.read(max(self.transport.in_waiting, 1), self.frame_gap_timeout)
+            if not b:
+                break
+            dropped += len(b)
+        if dropped:
+            self.logger.debug("dropped %i late bytes", dropped)
+
+    async def _receive(self, requests, timeout=None):
+        responses = {command: [] for command in requests}
+        missing = sum(requests.values())
+        parser = DalyFrameParser(logger=self.logger)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        first_timeout = self.timeout if timeout is None else timeout
+        timeout = first_timeout
+        start = time.monotonic()
+        x = 0
+        corrupt = {}
+        current = None
+        while missing > 0:
+            b = await self.transport.read(max(self.transport.in_waiting, parser.bytes_needed), timeout)
+            if len(b) == 0:
+                if current is not None and self._awaiting_first_frame(requests, responses, corrupt):
+                    current = None
+                    timeout = first_timeout
+                    continue
+                self.logger.debug("%i empty response, %i frames missing", x, missing)
+                break
+            for frame in parser.feed(b):
+                if debug:
+                    self.logger.debug("%i %s", x, frame.hex())
+                if self.capture:
+                    self.capture.write_response(frame)
+                if self._sort_frame(frame, requests, responses):
+                    if x == 0:
+                        self._record_latency(frame, requests, time.monotonic() - start)
+                    x += 1
+                    missing -= 1
+                    current = "%02x" % frame[2]
+            if parser.corrupt_commands:
+                command = "%02x" % parser.corrupt_commands[-1]
+                missing -= self._count_corrupt(parser, requests, responses, corrupt)
+                if command in requests:
+                    current = command
+            timeout = self._next_frame_timeout(current, requests, responses, corrupt, first_timeout)
+        self.corrupt_responses = set(corrupt)
+        if self.metrics:
+            self.metrics.receive(self.device, parser, requests, responses)
+        return responses
+
+    # wrap all sync functions so that they can be awaited,
+    # the parsers must not get called without response data as they would send a request on their own
+    async def get_soc(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("90")
+        if not response_data:
+            return False
+        return super().get_soc(response_data=response_data)
+
+    async def get_cell_voltage_range(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("91")
+        if not response_data:
+            return False
+        return super().get_cell_voltage_range(response_data=response_data)
+
+    async def get_temperature_range(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("92")
+        if not response_data:
+            return False
+        return super().get_temperature_range(response_data=response_data)
+
+    async def get_mosfet_status(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("93")
+        if not response_data:
+            return False
+        return super().get_mosfet_status(response_data=response_data)
+
+    async def get_status(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("94")
+        if not response_data:
+            return False
+        return super().get_status(response_data=response_data)
+
+    async def get_cell_voltages(self, response_data=None):
+        if not response_data:
+            max_responses = self._expected_responses("95")
+            if not max_responses:
+                return
+            response_data = await self._read_request("95", max_responses=max_responses, return_list=True)
+        if not response_data:
+            return False
+        return super().get_cell_voltages(response_data=response_data)
+
+    async def get_temperatures(self, response_data=None):
+        if not response_data:
+            max_responses = self._expected_responses("96")
+            if not max_responses:
+                return
+            response_data = await self._read_request("96", max_responses=max_responses, return_list=True)
+        if not response_data:
+            return False
+        return super().get_temperatures(response_data=response_data)
+
+    async def get_balancing_status(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("97")
+        if not response_data:
+            return False
+        return super().get_balancing_status(response_data=response_data)
+
+    async def get_errors(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("98")
+        if not response_data:
+            return False
+        return super().get_errors(response_data=response_data)
+
+    async def get_error_mask(self, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("98")
+        if not response_data:
+            return False
+        return super().get_error_mask(response_data=response_data)
+
+    async def get_all(self):
+        with polling_cycle(self.retry_policy):
+            data = {
+                "soc": await self.get_soc(),
+                "cell_voltage_range": await self.get_cell_voltage_range(),
+                "temperature_range": await self.get_temperature_range(),
+                "mosfet_status": await self.get_mosfet_status(),
+                "status": await self.get_status(),
+                "cell_voltages": await self.get_cell_voltages(),
+                "temperatures": await self.get_temperatures(),
+                "balancing_status": await self.get_balancing_status(),
+                "errors": await self.get_errors()
+            }
+            if self.history:
+                self.history.add(data)
+            return data
+
+    async def get_all_pipelined(self):
+        return (await self.get_snapshot()).to_dict()
+
+    async def get_snapshot(self, fields=None):
+        with polling_cycle(self.retry_policy):
+            if not self.status:
+                await self.get_status()
+            start = time.monotonic()
+            requests = self._snapshot_requests(fields)
+            responses = self._cached_responses(requests)
+            pending = {command: expected for command, expected in requests.items() if command not in responses}
+            if pending:
+                received = await self._read_pipeline(pending)
+                self._pipeline_done(pending, received)
+                responses.update(received)
+            incomplete = [command for command, expected in requests.items() if len(responses[command]) < expected]
+            if pending and incomplete:
+                await self._drain()
+            for command in incomplete:
+                expected = requests[command]
+                self.logger.debug("%s: got %i of %i responses, retrying", command, len(responses[command]),
+                                  expected)
+                responses[command] = await self._read_request(command, max_responses=expected,
+                                                              return_list=True) or []
+            if self.metrics:
+                self.metrics.request(self.device, "snapshot", time.monotonic() - start, 1,
+                                     all(len(responses[c]) >= e for c, e in requests.items()))
+            snapshot = self._parse_snapshot(responses)
+            if self.history:
+                self.history.add(snapshot)
+            return snapshot
+
+    def stream(self, interval=1, fields=None):
+        """
+        Same as DalyBMS.stream, but returns an async generator, e.g.
+
+            async for sample in bms.stream(interval=2, fields=("soc",)):
+                print(sample.timestamp, sample.data.soc.current)
+        """
+        if fields is not None:
+            fields = tuple(fields)
+            for field in fields:
+                self._snapshot_command(field)
+        return stream.async_poll(lambda: self.get_snapshot(fields), interval, metrics=self.metrics,
+                                 device=self.device)
+
+    async def set_charge_mosfet(self, on=True, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("da", extra="01" if on else "00")
+        if not response_data:
+            return False
+        return super().set_charge_mosfet(on=on, response_data=response_data)
+
+    async def set_discharge_mosfet(self, on=True, response_data=None):
+        if not response_data:
+            response_data = await self._read_request("d9", extra="01" if on else "00")
+        if not response_data:
+            return False
+        return super().set_discharge_mosfet(on=on, response_data=response_data)
+
+    async def set_soc(self, value):
+        v = round(value * 10.0)
+        v = min(max(v, 0), 1000)
+        response_data = await self._read_request("21", extra='000000000000%0.4X' % v)
+        if response_data:
+            self.logger.info(response_data.hex())
+
+    async def restart(self, response_data=None):
+        self.cache.invalidate()
+        return await self._read("00", timeout=self.frame_gap_timeout)
+
+
+class AsyncDalyBMSSinowealth(DalyBMSSinowealth):
+    def __init__(self, request_retries=3, logger=None, timeout=0.5, metrics=None, retry_policy=None,
+                 scan_batch_size=8, cache_ttls=None):
+        """
+
+        :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
+        :param logger: Python Logger object for output (Default: None)
+        :param timeout: Seconds to wait for a response (Default: 0.5)
+        :param metrics: Metrics object that counts requests and failures (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for learned timeouts (Default: None)
+        :param scan_batch_size: Number of register requests that get sent at once (Default: 8)
+        :param cache_ttls: Dict of register -> seconds a value gets reused, {} disables the cache
+                           (Default: CACHE_TTLS)
+        """
+        DalyBMSSinowealth.__init__(self, request_retries=request_retries, logger=logger, metrics=metrics,
+                                   retry_policy=retry_policy, scan_batch_size=scan_batch_size,
+                                   cache_ttls=cache_ttls)
+        self.timeout = timeout
+        self.transport = None
+
+    async def connect(self, device):
+        """
+        Connect to a serial device
+
+        :param device: Serial device, e.g. /dev/ttyUSB0
+        """
+        self.device = device
+        self.transport = AsyncSerialTransport(device, logger=self.logger)
+        self.transport.open()
+
+    async def disconnect(self):
+        if self.transport:
+            self.transport.close()
+
+    async def _read(self, command):
+        cached = self.cache.get(command.zfill(2))
+        if cached is not None:
+            return cached
+        if self.retry_policy and self.retry_policy.abandoned:
+            self.logger.debug("skipping %s, the BMS does not respond", command)
+            return False
+        length = self._response_length(command)
+        message_bytes = self._format_message(command, length)
+
+        self.transport.reset_input_buffer()
+
+        if not self.transport.write(message_bytes):
+            self.logger.error("serial write failed for command %s" % command)
+            return False
+
+        timeout = self.timeout
+        if self.retry_policy:
+            timeout = self.retry_policy.timeout(command.zfill(2), timeout)
+        start = time.monotonic()
+        response_data = await self._read_bytes(length + 1, timeout)
+        self._request_done(command, time.monotonic() - start, response_data)
+        return self._cache_value(command, self._parse_response(command, response_data))
+
+    async def _read_bytes(self, size, timeout):
+        """
+        :return: Up to 'size' bytes that arrived within 'timeout' seconds
+        """
+        response_data = b""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while len(response_data) < size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            b = await self.transport.read(size - len(response_data), remaining)
+            if not b:
+                break
+            response_data += b
+        return response_data
+
+    async def _scan(self, commands):
+        data, commands = self._split_cached(commands)
+        for offset in range(0, len(commands), self.scan_batch_size):
+            batch = commands[offset:offset + self.scan_batch_size]
+            if len(batch) == 1:
+                values = {batch[0]: await self._read(batch[0])}
+            else:
+                values = await self._scan_batch(batch)
+            data.update({command: value for command, value in values.items() if value is not False})
+        return data
+
+    async def _scan_batch(self, batch):
+        if self.retry_policy and self.retry_policy.abandoned:
+            self.logger.debug("skipping %s, the BMS does not respond", " ".join(batch))
+            return {}
+        message_bytes, size = self._scan_message(batch)
+
+        self.transport.reset_input_buffer()
+
+        if not self.transport.write(message_bytes):
+            self.logger.error("serial write failed for registers %s" % " ".join(batch))
+            return {}
+
+        start = time.monotonic()
+        response_data = await self._read_bytes(size, self.timeout + size * 10 / self.transport.baudrate)
+        self._request_done("scan", time.monotonic() - start, response_data)
+
+        data = self._parse_scan(batch, response_data)
+        if data is None:
+            return {command: await self._read(command) for command in batch}
+        return data
+
+    async def _cell_count(self):
+        if self.cells is None:
+            self.cells = self._parse_cell_count(await self._read("17"))
+        return self.cells
+
+    async def _read_registers(self, requests):
+        values = await self._scan([command[0] for command in requests.values()])
+        return self._select(requests, values)
+
+    async def _read_cell_voltages(self):
+        cells = await self._cell_count()
+        if cells:
+            registers = self._cell_registers(cells)
+            return self._collect_cell_voltages(registers, await self._scan(registers))
+
+        response_data = []
+        for x in range(1, self.MAX_CELLS + 1):
+            value = await self._read("%02x" % x)
+            if not value:
+                break
+            response_data.append(value)
+        return response_data
+
+    async def get_cell_voltages(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_cell_voltages()
+        return super().get_cell_voltages(response_data=response_data)
+
+    async def get_soc(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_registers(self.SOC_REGISTERS)
+        return super().get_soc(response_data=response_data)
+
+    async def get_power(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_registers(self.POWER_REGISTERS)
+        return super().get_power(response_data=response_data)
+
+    async def get_temperatures(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_registers(self.TEMPERATURE_REGISTERS)
+        return super().get_temperatures(response_data=response_data)
+
+    async def get_status(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_registers(self.STATUS_REGISTERS)
+        return super().get_status(response_data=response_data)
+
+    async def get_mosfet_status(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read_registers(self.MOSFET_REGISTERS)
+        return super().get_mosfet_status(response_data=response_data)
+
+    async def get_errors(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read("16")
+        return super().get_errors(response_data=response_data)
+
+    async def get_error_mask(self, response_data=None):
+        if response_data is None:
+            response_data = await self._read("16")
+        return response_data
+
+    async def get_cell_voltage_range(self):
+        return {}
+
+    async def get_temperature_range(self):
+        return {}
+
+    async def get_balancing_status(self):
+        return {}
+
+    async def get_all(self):
+        with polling_cycle(self.retry_policy):
+            cells = await self._cell_count()
+            if cells:
+                return self._parse_snapshot(cells, await self._scan(self._snapshot_registers(cells)))
+            return {
+                "soc": await self.get_soc(),
+                "mosfet_status": await self.get_mosfet_status(),
+                "status": await self.get_status(),
+                "cell_voltages": await self.get_cell_voltages(),
+                "temperatures": await self.get_temperatures(),
+                "errors": await self.get_errors()
+            }
+
+    async def _read_fields(self, fields):
+        if fields is None:
+            return await self.get_all()
+        return {field: await getattr(self, "get_%s" % field)() for field in fields}
+
+    def stream(self, interval=1, fields=None):
+        """
+        Same as DalyBMSSinowealth.stream, but returns an async generator
+        """
+        fields = self._stream_fields(fields)
+        return stream.async_poll(lambda: self._read_fields(fields), interval, metrics=self.metrics,
+                                 device=self.device)
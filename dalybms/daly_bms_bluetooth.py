@@ -1,32 +1,74 @@
 import asyncio
 import subprocess
+import time
 import logging
 from bleak import BleakClient
 
+from . import codec, stream
 from .daly_bms import DalyBMS
+from .frame_parser import DalyFrameParser
+from .retry_policy import polling_cycle
 
 
 class DalyBMSBluetooth(DalyBMS):
-    def __init__(self, request_retries=3, logger=None):
+    def __init__(self, request_retries=3, logger=None, capture=None, metrics=None, retry_policy=None,
+                 cache_ttls=None, max_in_flight=4, client_factory=None):
         """
 
         :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
         :param logger: Python Logger object for output (Default: None)
+        :param capture: CaptureWriter object that records all request and response frames (Default: None)
+        :param metrics: Metrics object that counts requests, retries and timeouts (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for learned timeouts and retry backoff
+                             (Default: None, 5 seconds timeout and 0.2 seconds between retries)
+        :param cache_ttls: Dict of command ID -> seconds a response gets reused, {} disables the cache
+                           (Default: CACHE_TTLS)
+        :param max_in_flight: Number of different commands that can wait for their responses at the same time
+                              (Default: 4)
+        :param client_factory: Function that takes the MAC address and returns a BleakClient compatible object
+                               (Default: BleakClient)
         """
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
-        DalyBMS.__init__(self, request_retries=request_retries, address=8, logger=logger)
+        DalyBMS.__init__(self, request_retries=request_retries, address=8, logger=logger, capture=capture,
+                         metrics=metrics, retry_policy=retry_policy, cache_ttls=cache_ttls)
         self.client = None
-        self.response_cache = {}
+        self.client_factory = client_factory
+        self.parser = DalyFrameParser(logger=self.logger)
+        self.pending = {}  # command ID -> _PendingRequest
+        self.max_in_flight = max_in_flight
+        self._command_locks = {}
+        # created in connect(), asyncio objects bind to the event loop that is running when they get created
+        # on Python < 3.10
+        self._in_flight = None
+        self._write_lock = None
 
     async def connect(self, mac_address):
         """
-        Open the connection to the Bluetooth device.
+        Open the connection to the Bluetooth device. Calling it again reconnects with the same client.
 
         :param mac_address: MAC address of the Bluetooth device
         """
+        if self.client is None or self.device != mac_address:
+            if self.client_factory:
+                self.client = self.client_factory(mac_address)
+            else:
+                # bluetoothctl blocks, so it must not run in the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self._disconnect_stale, mac_address)
+                self.client = BleakClient(mac_address)
+        self.device = mac_address
+        if self._write_lock is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+            self._write_lock = asyncio.Lock()
+        self.parser.reset()
+        await self.client.connect()
+        await self.client.start_notify(17, self._notification_callback)
+        await self.client.write_gatt_char(48, bytearray(b""))
+
+    @staticmethod
+    def _disconnect_stale(mac_address):
         try:
             """
             When an earlier execution of the script crashed, the connection to the devices stays open and future 
@@ -40,10 +82,10 @@ class DalyBMSBluetooth(DalyBMS):
             open_blue.kill()
         except:
             pass
-        self.client = BleakClient(mac_address)
-        await self.client.connect()
-        await self.client.start_notify(17, self._notification_callback)
-        await self.client.write_gatt_char(48, bytearray(b""))
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
 
     async def disconnect(self):
         """
@@ -54,17 +96,25 @@ class DalyBMSBluetooth(DalyBMS):
         self.logger.info("Bluetooth Disconnected")
 
     async def _read_request(self, command, max_responses=1):
+        cached = self._cached_response(command, return_list=max_responses != 1)
+        if cached is not None:
+            return cached
+        if self._cycle_abandoned(command):
+            return False
         response_data = None
         x = None
-        for x in range(0, self.request_retries):
+        tries = self._request_tries()
+        start = time.monotonic()
+        for x in range(0, tries):
             response_data = await self._read(
                 command=command,
                 max_responses=max_responses)
             if not response_data:
                 self.logger.debug("%x. try failed, retrying..." % (x + 1))
-                await asyncio.sleep(0.2)
+                await asyncio.sleep(self._retry_delay(x + 1, tries))
             else:
                 break
+        self._request_done(command, start, x + 1, response_data)
         if not response_data:
             self.logger.error('%s failed after %s tries' % (command, x + 1))
             return False
@@ -72,13 +122,20 @@ class DalyBMSBluetooth(DalyBMS):
 
     async def _read(self, command, max_responses=1):
         self.logger.debug("-- %s ------------------------" % command)
-        self.response_cache[command] = {"queue": [],
-                                        "future": asyncio.Future(),
-                                        "max_responses": max_responses,
-                                        "done": False}
-
-        message_bytes = self._format_message(command)
-        result = await self._async_char_write(command, message_bytes)
+        # different commands can be in flight at the same time, the same command only once
+        lock = self._command_locks.get(command)
+        if lock is None:
+            lock = self._command_locks[command] = asyncio.Lock()
+        async with lock, self._in_flight:
+            request = _PendingRequest(asyncio.get_running_loop().create_future(), max_responses)
+            self.pending[command] = request
+            try:
+                message_bytes = self._format_message(command)
+                if self.capture:
+                    self.capture.write_requests(message_bytes)
+                result = await self._async_char_write(command, message_bytes)
+            finally:
+                del self.pending[command]
         self.logger.debug("got %s" % result)
         if not result:
             return False
@@ -88,93 +145,151 @@ class DalyBMSBluetooth(DalyBMS):
             return result
 
     def _notification_callback(self, handle, data):
-        self.logger.debug("%s %s %s" % (handle, repr(data), len(data)))
-        responses = []
-        if len(data) == 13:
-            responses.append(data)
-        elif len(data) == 26:
-            responses.append(data[0:13])
-            responses.append(data[13:])
-        else:
-            self.logger.error(len(data), "bytes received, not 13 or 26, not implemented")
-
-        for response_bytes in responses:
-            command = response_bytes[2:3].hex()
-            if self.response_cache[command]["done"] is True:
-                self.logger.debug("skipping response for %s, done" % command)
-                return
-            self.response_cache[command]["queue"].append(response_bytes[4:-1])
-            if len(self.response_cache[command]["queue"]) == self.response_cache[command]["max_responses"]:
-                self.response_cache[command]["done"] = True
-                self.response_cache[command]["future"].set_result(self.response_cache[command]["queue"])
+        """
+        Notifications can split or join frames in any way, so they are reassembled by a frame parser
+        and every frame is handed to the request of its command
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s %s %i", handle, bytes(data).hex(), len(data))
+        for frame in self.parser.feed(data):
+            if self.capture:
+                self.capture.write_response(frame)
+            command = "%02x" % frame[2]
+            request = self.pending.get(command)
+            if request is None or request.future.done():
+                self.logger.debug("skipping response for %s, no request waiting", command)
+                continue
+            request.responses.append(codec.frame_data(frame))
+            if len(request.responses) >= request.max_responses:
+                request.future.set_result(request.responses)
 
     async def _async_char_write(self, command, value):
         if not self.client.is_connected:
             self.logger.info("Connecting...")
             await self.client.connect()
 
-        await self.client.write_gatt_char(15, value)
+        async with self._write_lock:
+            await self.client.write_gatt_char(15, value)
         self.logger.debug("Waiting...")
+        # the timeout covers all response frames, so it is learned from the time until the last one
+        timeout = self._first_frame_timeout(command, 5) or 5
+        start = time.monotonic()
         try:
-            result = await asyncio.wait_for(self.response_cache[command]["future"], 5)
+            result = await asyncio.wait_for(self.pending[command].future, timeout)
         except asyncio.TimeoutError:
             self.logger.warning("Timeout while waiting for %s response" % command)
+            if self.metrics:
+                self.metrics.count("dalybms_timeouts_total", self.device, command)
             return False
+        if self.retry_policy:
+            self.retry_policy.record(command, time.monotonic() - start)
         self.logger.debug("got %s" % result)
         return result
 
-    # wrap all sync functions so that they can be awaited
+    # wrap all sync functions so that they can be awaited,
+    # the parsers must not get called without response data as they would send a request on their own
     async def get_soc(self, response_data=None):
         response_data = await self._read_request("90")
+        if not response_data:
+            return False
         return super().get_soc(response_data=response_data)
 
     async def get_cell_voltage_range(self, response_data=None):
         response_data = await self._read_request("91")
+        if not response_data:
+            return False
         return super().get_cell_voltage_range(response_data=response_data)
 
-    async def get_max_min_temperature(self, response_data=None):
+    async def get_temperature_range(self, response_data=None):
         response_data = await self._read_request("92")
-        return super().get_max_min_temperature(response_data=response_data)
+        if not response_data:
+            return False
+        return super().get_temperature_range(response_data=response_data)
 
     async def get_mosfet_status(self, response_data=None):
         response_data = await self._read_request("93")
+        if not response_data:
+            return False
         return super().get_mosfet_status(response_data=response_data)
 
     async def get_status(self, response_data=None):
         response_data = await self._read_request("94")
+        if not response_data:
+            return False
         return super().get_status(response_data=response_data)
 
     async def get_cell_voltages(self, response_data=None):
         if not self.status:
             await self.get_status()
-        max_responses = self._calc_cell_voltage_responses()
+        max_responses = self._expected_responses("95")
         if not max_responses:
             return
         response_data = await self._read_request("95", max_responses=max_responses)
-
+        if not response_data:
+            return False
         return super().get_cell_voltages(response_data=response_data)
 
     async def get_temperatures(self, response_data=None):
-        response_data = await self._read_request("95")
+        if not self.status:
+            await self.get_status()
+        max_responses = self._expected_responses("96")
+        if not max_responses:
+            return
+        response_data = await self._read_request("96", max_responses=max_responses)
+        if not response_data:
+            return False
         return super().get_temperatures(response_data=response_data)
 
     async def get_balancing_status(self, response_data=None):
-        response_data = await self._read_request("96")
+        response_data = await self._read_request("97")
+        if not response_data:
+            return False
         return super().get_balancing_status(response_data=response_data)
 
     async def get_errors(self, response_data=None):
-        response_data = await self._read_request("97")
+        response_data = await self._read_request("98")
+        if not response_data:
+            return False
         return super().get_errors(response_data=response_data)
 
-    async def get_all(self):
-        return {
-            "soc": await self.get_soc(),
-            "cell_voltage_range": await self.get_cell_voltage_range(),
-            "temperature_range": await self.get_temperature_range(),
-            "mosfet_status": await self.get_mosfet_status(),
-            "status": await self.get_status(),
-            "cell_voltages": await self.get_cell_voltages(),
-            "temperatures": await self.get_temperatures(),
-            "balancing_status": await self.get_balancing_status(),
-            "errors": await self.get_errors()
-        }
+    async def get_error_mask(self, response_data=None):
+        response_data = await self._read_request("98")
+        if not response_data:
+            return False
+        return super().get_error_mask(response_data=response_data)
+
+    async def get_all(self, fields=None):
+        """
+        Sends all requests at once, the responses arrive over the same connection in any order
+
+        :param fields: Names of the fields to read, see SNAPSHOT_FIELDS (Default: all)
+        """
+        with polling_cycle(self.retry_policy):
+            if not self.status:
+                # the cell and sensor count decide how many frames to wait for
+                await self.get_status()
+            keys = tuple(self.SNAPSHOT_FIELDS if fields is None else fields)
+            results = await asyncio.gather(*[getattr(self, "get_%s" % key)() for key in keys])
+            data = dict(zip(keys, results))
+            if self.history:
+                self.history.add(data)
+            return data
+
+    def stream(self, interval=1, fields=None):
+        """
+        Async generator of get_all results on fixed deadlines, see DalyBMS.stream and AsyncDalyBMS.stream
+        """
+        if fields is not None:
+            fields = tuple(fields)
+            for field in fields:
+                self._snapshot_command(field)
+        return stream.async_poll(lambda: self.get_all(fields), interval, metrics=self.metrics, device=self.device)
+
+
+class _PendingRequest:
+    __slots__ = ("future", "max_responses", "responses")
+
+    def __init__(self, future, max_responses):
+        self.future = future
+        self.max_responses = max_responses
+        self.responses = []
@@ -0,0 +1,185 @@
+import serial
+import threading
+import time
+import logging
+
+from . import codec
+from .daly_bms import DalyBMS
+
+
+class DalyBMSBus:
+    """
+    Shares one RS485 port between several BMS with different board numbers (BMS addresses).
+    Requests are serialized in the order in which they were made, with a turnaround gap between them.
+    """
+
+    def __init__(self, turnaround_time=0.01, logger=None):
+        """
+
+        :param turnaround_time: Seconds between the end of a response and the next request on the bus,
+                                gives the transceivers time to switch direction (Default: 0.01)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.turnaround_time = turnaround_time
+        self.serial = None
+        self.devices = {}
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._last_transaction_end = 0
+        self._poll_offset = 0
+
+    def connect(self, device):
+        """
+        Connect to a serial device
+
+        :param device: Serial device, e.g. /dev/ttyUSB0
+        """
+        self.serial = serial.Serial(
+            port=device,
+            baudrate=9600,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=0.5,
+            xonxoff=False,
+            writeTimeout=0.5
+        )
+
+    def disconnect(self):
+        if self.serial and self.serial.is_open:
+            self.serial.close()
+
+    def add_bms(self, bms_address, request_retries=3, logger=None, metrics=None, retry_policy=None):
+        """
+        Adds a BMS to the bus and reads its status
+
+        :param bms_address: Board number of the BMS (1 - 16), see codec.request_frame
+        :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
+        :param logger: Python Logger object for output (Default: logger of the bus)
+        :param metrics: Metrics object, the device label is the port and the address (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for this BMS, a BMS that stops responding then
+                             holds the bus only for one try per poll (Default: None)
+        :return: DalyBMS object for this BMS address
+        """
+        if not 1 <= bms_address <= 16:
+            raise ValueError("BMS address %i is out of range, use 1 - 16" % bms_address)
+        if bms_address in self.devices:
+            raise ValueError("BMS address %i is already on the bus" % bms_address)
+        bms = DalyBMSBusDevice(bus=self, request_retries=request_retries, bms_address=bms_address,
+                               logger=logger or self.logger, metrics=metrics, retry_policy=retry_policy)
+        bms.device = "%s:%i" % (self.serial.port, bms_address)
+        self.devices[bms_address] = bms
+        bms.get_status()
+        return bms
+
+    def transaction(self):
+        """
+        Context manager that gives exclusive access to the bus. Waiting callers get served first come, first served.
+        """
+        return _BusTransaction(self)
+
+    def _acquire(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+        gap = self._last_transaction_end + self.turnaround_time - time.monotonic()
+        if gap > 0:
+            time.sleep(gap)
+
+    def _release(self):
+        with self._condition:
+            self._last_transaction_end = time.monotonic()
+            self._serving += 1
+            self._condition.notify_all()
+
+    def poll(self, methods=("get_all",), addresses=None):
+        """
+        Runs the given getters on all BMS. The requests are interleaved, so every BMS gets its first
+        getter called before any BMS gets its second one, and the BMS that starts rotates with each call.
+
+        :param methods: Names of the DalyBMS getters to call (Default: get_all)
+        :param addresses: BMS addresses to poll (Default: all BMS on the bus)
+        :return: Dict of BMS address -> dict of method name -> result
+        """
+        if addresses is None:
+            addresses = list(self.devices)
+        if not addresses:
+            return {}
+        offset = self._poll_offset % len(addresses)
+        self._poll_offset += 1
+        order = addresses[offset:] + addresses[:offset]
+
+        results = {address: {} for address in addresses}
+        for method in methods:
+            for address in order:
+                results[address][method] = getattr(self.devices[address], method)()
+        return results
+
+
+class _BusTransaction:
+    def __init__(self, bus):
+        self.bus = bus
+
+    def __enter__(self):
+        self.bus._acquire()
+        return self.bus
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.bus._release()
+
+
+class DalyBMSBusDevice(DalyBMS):
+    """
+    A BMS on a shared bus, created by DalyBMSBus.add_bms. The bus owns the serial port.
+    Requests go to its board number and responses from other BMS get dropped.
+    """
+
+    def __init__(self, bus, request_retries=3, bms_address=1, logger=None, metrics=None, retry_policy=None):
+        DalyBMS.__init__(self, request_retries=request_retries, address=4, logger=logger, metrics=metrics,
+                         retry_policy=retry_policy)
+        self.bus = bus
+        self.bms_address = bms_address
+        # a shared bus is always RS485, where the BMS leaves out empty frames
+        self.sends_empty_frames = False
+
+    @property
+    def serial(self):
+        return self.bus.serial
+
+    def connect(self, device):
+        raise RuntimeError("the serial port is owned by the bus, use DalyBMSBus.connect")
+
+    def disconnect(self):
+        # the port stays open for the other BMS on the bus
+        pass
+
+    def _format_message(self, command, extra=""):
+        message_bytes = codec.request_frame(self.address, command, extra, self.bms_address)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("w %s", message_bytes.hex())
+        return message_bytes
+
+    def _sort_frame(self, frame, requests, responses):
+        if frame[1] != self.bms_address:
+            self.logger.debug("skipping response of BMS address %i", frame[1])
+            return False
+        return super()._sort_frame(frame, requests, responses)
+
+    def _read(self, *args, **kwargs):
+        with self.bus.transaction():
+            return super()._read(*args, **kwargs)
+
+    def _read_pipeline(self, requests):
+        with self.bus.transaction():
+            return super()._read_pipeline(requests)
+
+    def _drain(self):
+        with self.bus.transaction():
+            super()._drain()
@@ -1,7 +1,13 @@
 import serial
 import struct
+import time
 import logging
 
+from . import stream
+from .alarms import AlarmDecoder
+from .cache import ResponseCache
+from .retry_policy import polling_cycle
+
 """
 List from BMStool PC / Sinowealth
 1 = Cell 1 Voltage
@@ -26,6 +32,7 @@ List from BMStool PC / Sinowealth
 
 
 class DalyBMSSinowealth:
+    # the keys of PACK_STATUS and BATTERY_STATUS count from the most significant bit of the 16 bit registers
     PACK_STATUS = {
         0: 'CAL: ',
         5: 'VDQ: Valid Discharge Qualified',
@@ -54,17 +61,78 @@ class DalyBMSSinowealth:
         15: 'OV: Overvoltage protection occurs',
     }
 
-    def __init__(self, request_retries=3, logger=None):
+    PACK_STATES = AlarmDecoder({15 - position: name for position, name in PACK_STATUS.items()}, msb_first=True)
+
+    # decoder of the battery status register, see get_error_mask and alarms.AlarmTracker
+    ALARMS = AlarmDecoder({15 - position: name for position, name in BATTERY_STATUS.items()}, msb_first=True)
+
+    MAX_CELLS = 10
+
+    # register -> seconds a value gets cached: full charge capacity, cycle count and pack config
+    CACHE_TTLS = {
+        "11": 3600,
+        "14": 300,
+        "17": 3600,
+    }
+
+    # key -> (register, divisor), a divisor of None keeps the raw value
+    SOC_REGISTERS = {
+        "total_voltage": ("b", 1000),
+        "current": ("10", 1000),
+        "soc_percent": ("13", 1)
+    }
+
+    # the readings of the energy counters, see get_power
+    POWER_REGISTERS = {
+        "total_voltage": ("b", 1000),
+        "current": ("10", 1000),
+    }
+
+    TEMPERATURE_REGISTERS = {
+        "external1": ("c", 10),
+        "external2": ("d", 10),
+        # "ic1": ("e", 10),
+        # "ic2": ("f", 100), # always 71
+    }
+
+    STATUS_REGISTERS = {
+        "cycles": ("14", 1),
+    }
+
+    MOSFET_REGISTERS = {
+        "full_capacity_ah": ("11", 1000),
+        "remaining_capacity_ah": ("12", 1000),
+        "pack_state": ("15", None),
+    }
+
+    # fields of get_all, each is read by its get_* method when a stream selects fields
+    FIELDS = ("soc", "mosfet_status", "status", "cell_voltages", "temperatures", "errors")
+
+    def __init__(self, request_retries=3, logger=None, metrics=None, retry_policy=None, scan_batch_size=8,
+                 cache_ttls=None):
         """
 
         :param request_retries: How often read requests should get repeated in case that they fail (Default: 3).
         :param logger: Python Logger object for output (Default: None)
+        :param metrics: Metrics object that counts requests and failures (Default: None)
+        :param retry_policy: AdaptiveRetryPolicy object for learned timeouts, the rest of get_all gets skipped
+                             once the BMS stops responding (Default: None)
+        :param scan_batch_size: Number of register requests that get sent at once, 1 reads the registers
+                                one by one (Default: 8)
+        :param cache_ttls: Dict of register -> seconds a value gets reused, {} disables the cache
+                           (Default: CACHE_TTLS)
         """
         if logger:
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
         self.request_retries = request_retries
+        self.metrics = metrics
+        self.retry_policy = retry_policy
+        self.scan_batch_size = max(scan_batch_size, 1)
+        self.cells = None  # learned from the pack config register
+        self.cache = ResponseCache(self.CACHE_TTLS if cache_ttls is None else cache_ttls)
+        self.device = None
 
     def connect(self, device):
         """
@@ -72,6 +140,7 @@ class DalyBMSSinowealth:
 
         :param device: Serial device, e.g. /dev/ttyUSB0
         """
+        self.device = device
         self.serial = serial.Serial(
             port=device,
             baudrate=9600,
@@ -93,13 +162,39 @@ class DalyBMSSinowealth:
         self.logger.debug("message: %s, %s" % (message_bytes, message_bytes.hex()))
         return message_bytes
 
+    @staticmethod
+    def _response_length(command):
+        if command in ("10", "11", "12"):
+            return 4
+        return 2
+
+    def fresh(self):
+        """
+        Context manager in which all registers get read from the BMS instead of the cache
+        """
+        return self.cache.fresh()
+
+    def invalidate(self, *commands):
+        """
+        Drops cached register values
+
+        :param commands: Registers, all if none are given
+        """
+        commands = [command.zfill(2) for command in commands]
+        self.cache.invalidate(*commands)
+        if not commands or "17" in commands:
+            self.cells = None
+
     def _read(self, command):
+        cached = self.cache.get(command.zfill(2))
+        if cached is not None:
+            return cached
+        if self.retry_policy and self.retry_policy.abandoned:
+            self.logger.debug("skipping %s, the BMS does not respond", command)
+            return False
         if not self.serial.is_open:
             self.serial.open()
-        if command in ("10", "11", "12"):
-            length = 4
-        else:
-            length = 2
+        length = self._response_length(command)
         message_bytes = self._format_message(command, length)
 
         # clear all buffers, in case something is left from a previous command that failed
@@ -110,7 +205,170 @@ class DalyBMSSinowealth:
             self.logger.error("serial write failed for command" % command)
             return False
 
-        response_data = self.serial.read(length + 1)
+        port_timeout = self.serial.timeout
+        if self.retry_policy:
+            self.serial.timeout = self.retry_policy.timeout(command.zfill(2), port_timeout)
+        start = time.monotonic()
+        try:
+            response_data = self.serial.read(length + 1)
+        finally:
+            self.serial.timeout = port_timeout
+        self._request_done(command, time.monotonic() - start, response_data)
+        return self._cache_value(command, self._parse_response(command, response_data))
+
+    def _cache_value(self, command, value):
+        self.cache.put(command.zfill(2), value)
+        return value
+
+    def _request_done(self, command, latency, response_data):
+        """
+        Updates the metrics and the retry policy after a request
+
+        :param latency: Seconds between the request and the end of the response
+        """
+        command = command.zfill(2)
+        if self.metrics:
+            self.metrics.request(self.device, command, latency, 1, len(response_data) > 0)
+        if self.retry_policy:
+            if response_data:
+                self.retry_policy.record(command, latency)
+                self.retry_policy.success()
+            else:
+                self.retry_policy.failure()
+
+    def _scan(self, commands):
+        """
+        Reads several registers, in batches of scan_batch_size requests that get written at once.
+        The replies come back to back in the order of the requests.
+
+        :param commands: List of registers
+        :return: Dict of register -> raw value, registers without reply are left out
+        """
+        data, commands = self._split_cached(commands)
+        for offset in range(0, len(commands), self.scan_batch_size):
+            batch = commands[offset:offset + self.scan_batch_size]
+            if len(batch) == 1:
+                values = {batch[0]: self._read(batch[0])}
+            else:
+                values = self._scan_batch(batch)
+            data.update({command: value for command, value in values.items() if value is not False})
+        return data
+
+    def _split_cached(self, commands):
+        """
+        :return: Tuple of a dict register -> cached value and the list of registers that have to be read
+        """
+        data = {}
+        pending = []
+        for command in commands:
+            cached = self.cache.get(command.zfill(2))
+            if cached is None:
+                pending.append(command)
+            else:
+                data[command] = cached
+        return data, pending
+
+    def _scan_batch(self, batch):
+        if self.retry_policy and self.retry_policy.abandoned:
+            self.logger.debug("skipping %s, the BMS does not respond", " ".join(batch))
+            return {}
+        if not self.serial.is_open:
+            self.serial.open()
+        message_bytes, size = self._scan_message(batch)
+
+        # clear all buffers, in case something is left from a previous command that failed
+        self.serial.reset_input_buffer()
+        self.serial.reset_output_buffer()
+
+        if not self.serial.write(message_bytes):
+            self.logger.error("serial write failed for registers %s" % " ".join(batch))
+            return {}
+
+        port_timeout = self.serial.timeout
+        # the port timeout for the first reply plus the transfer time of the others, 10 bits per byte
+        self.serial.timeout = port_timeout + size * 10 / self.serial.baudrate
+        start = time.monotonic()
+        try:
+            response_data = self.serial.read(size)
+        finally:
+            self.serial.timeout = port_timeout
+        self._request_done("scan", time.monotonic() - start, response_data)
+
+        data = self._parse_scan(batch, response_data)
+        if data is None:
+            return {command: self._read(command) for command in batch}
+        return data
+
+    def _scan_message(self, batch):
+        """
+        :return: Tuple of the request bytes of all registers and the expected number of response bytes
+        """
+        message_bytes = bytearray()
+        size = 0
+        for command in batch:
+            length = self._response_length(command)
+            message_bytes += self._format_message(command, length)
+            size += length + 1
+        return message_bytes, size
+
+    def _parse_scan(self, batch, response_data):
+        """
+        Splits the replies of a batch of registers
+
+        :return: Dict of register -> raw value, or None if replies are missing
+        """
+        size = sum(self._response_length(command) + 1 for command in batch)
+        if len(response_data) != size:
+            # there is no header to tell which reply is missing, so all registers have to be read again
+            self.logger.debug("got %i of %i bytes for registers %s, reading them one by one",
+                              len(response_data), size, " ".join(batch))
+            return None
+        data = {}
+        offset = 0
+        for command in batch:
+            length = self._response_length(command) + 1
+            data[command] = self._cache_value(command,
+                                              self._parse_response(command, response_data[offset:offset + length]))
+            offset += length
+        return data
+
+    def _parse_cell_count(self, pack_config):
+        """
+        :param pack_config: Raw value of the pack config register
+        :return: Number of cells, or None if it is not plausible
+        """
+        if pack_config is False or pack_config is None:
+            return None
+        cells = pack_config & 0xF
+        if not 1 <= cells <= self.MAX_CELLS:
+            self.logger.debug("implausible cell count %i in pack config %04x", cells, pack_config)
+            return None
+        return cells
+
+    def _cell_count(self):
+        """
+        :return: Number of cells from the pack config register, read once until invalidate(), or None if unknown
+        """
+        if self.cells is None:
+            self.cells = self._parse_cell_count(self._read("17"))
+        return self.cells
+
+    def _cell_registers(self, cells):
+        return ["%02x" % x for x in range(1, cells + 1)]
+
+    @staticmethod
+    def _collect_cell_voltages(registers, values):
+        """
+        :return: List of raw cell voltages, up to the first missing one
+        """
+        response_data = []
+        for command in registers:
+            if command not in values:
+                break
+            response_data.append(values[command])
+        return response_data
+
+    def _parse_response(self, command, response_data):
         if len(response_data) == 0:
             self.logger.debug("empty response for command %s" % (command))
             return False
@@ -119,103 +377,170 @@ class DalyBMSSinowealth:
         if command in ("10", "11", "12"):
             return struct.unpack('>i x', response_data)[0]
         elif command in ("15", "16", "17", "18"):
-            return bin(int.from_bytes(response_data[:-1], byteorder='big'))[2:].zfill(16)
+            # bit fields
+            return int.from_bytes(response_data[:-1], byteorder='big')
+        elif command.zfill(2) == "0b":
+            # total voltage in mV, unsigned as packs with 10 cells exceed 32.767 V
+            return struct.unpack('>H x', response_data)[0]
         else:
             return struct.unpack('>h x', response_data)[0]
 
-    def get_cell_voltages(self):
-        max_cells = 10
-        x = 1
-        cell_voltages = {}
-        while x <= max_cells:
-            response_data = self._read("%02x" % x)
-            if not response_data:
+    def _read_cell_voltages(self):
+        cells = self._cell_count()
+        if cells:
+            registers = self._cell_registers(cells)
+            return self._collect_cell_voltages(registers, self._scan(registers))
+
+        # unknown cell count, probe the registers
+        response_data = []
+        for x in range(1, self.MAX_CELLS + 1):
+            value = self._read("%02x" % x)
+            if not value:
+                # no response or 0 after the last cell
                 break
-            if response_data == 0:
+            response_data.append(value)
+        return response_data
+
+    def get_cell_voltages(self, response_data=None):
+        """
+        :param response_data: List of raw register values, starting with cell 1 (Default: read from the BMS)
+        """
+        if response_data is None:
+            response_data = self._read_cell_voltages()
+
+        cell_voltages = {}
+        for x, value in enumerate(response_data, start=1):
+            if not value:
                 # last cell
                 break
-
-            cell_voltages[x] = response_data / 1000
-            x += 1
+            cell_voltages[x] = value / 1000
 
         return cell_voltages
 
-    def _read_bulk(self, requests):
+    def _read_registers(self, requests):
+        """
+        Reads the raw value of each register, the ones that fail are left out
+
+        :param requests: Dict of key -> (command, divisor)
+        :return: Dict of key -> raw register value
+        """
+        values = self._scan([command[0] for command in requests.values()])
+        return self._select(requests, values)
+
+    @staticmethod
+    def _select(requests, values):
+        """
+        :param requests: Dict of key -> (command, divisor)
+        :param values: Dict of register -> raw value
+        :return: Dict of key -> raw value
+        """
+        return {key: values[command[0]] for key, command in requests.items() if command[0] in values}
+
+    def _snapshot_registers(self, cells):
+        registers = self._cell_registers(cells)
+        for requests in (self.SOC_REGISTERS, self.MOSFET_REGISTERS, self.STATUS_REGISTERS,
+                         self.TEMPERATURE_REGISTERS):
+            registers += [command[0] for command in requests.values()]
+        registers.append("16")
+        return registers
+
+    def _parse_snapshot(self, cells, values):
+        """
+        :param values: Dict of register -> raw value of all registers of _snapshot_registers
+        :return: Same result as get_all
+        """
+        # call the parsers of this class, subclasses might wrap them in coroutines
+        return {
+            "soc": DalyBMSSinowealth.get_soc(self, response_data=self._select(self.SOC_REGISTERS, values)),
+            "mosfet_status": DalyBMSSinowealth.get_mosfet_status(
+                self, response_data=self._select(self.MOSFET_REGISTERS, values)),
+            "status": DalyBMSSinowealth.get_status(self, response_data=self._select(self.STATUS_REGISTERS, values)),
+            "cell_voltages": DalyBMSSinowealth.get_cell_voltages(
+                self, response_data=self._collect_cell_voltages(self._cell_registers(cells), values)),
+            "temperatures": DalyBMSSinowealth.get_temperatures(
+                self, response_data=self._select(self.TEMPERATURE_REGISTERS, values)),
+            "errors": DalyBMSSinowealth.get_errors(self, response_data=values.get("16", False)),
+        }
+
+    def _read_bulk(self, requests, response_data=None):
+        """
+        :param requests: Dict of key -> (command, divisor), a divisor of None keeps the raw value
+        :param response_data: Dict of key -> raw register value (Default: read from the BMS)
+        """
+        if response_data is None:
+            response_data = self._read_registers(requests)
+
         data = {}
         for key, command in requests.items():
-            response_data = self._read(command[0])
-            if response_data is False:
+            if key not in response_data:
                 continue
-            data[key] = response_data / command[1]
+            if command[1] is None:
+                data[key] = response_data[key]
+            else:
+                data[key] = response_data[key] / command[1]
 
         return data
 
-    def get_soc(self):
-        requests = {
-            "total_voltage": ("b", 1000),
-            "current": ("10", 1000),
-            "soc_percent": ("13", 1)
-        }
-        return self._read_bulk(requests)
+    def get_soc(self, response_data=None):
+        return self._read_bulk(self.SOC_REGISTERS, response_data=response_data)
+
+    def get_power(self, response_data=None):
+        """
+        Like get_soc without the SOC register, the voltage and current get read in one round trip
 
-    def get_temperatures(self):
+        :return: Dict with total_voltage and current
+        """
+        return self._read_bulk(self.POWER_REGISTERS, response_data=response_data)
+
+    def get_temperatures(self, response_data=None):
         # The BMS returns temperatures in Kelvin
         # 2731 / 10 = 273,1 K = 0°C
-        requests = {
-            "external1": ("c", 10),
-            "external2": ("d", 10),
-            # "ic1": ("e", 10),
-            # "ic2": ("f", 100), # always 71
-        }
-        responses = self._read_bulk(requests)
+        responses = self._read_bulk(self.TEMPERATURE_REGISTERS, response_data=response_data)
 
         for key, value in responses.items():
             # change temperatures from Kelvin to °C
             responses[key] = round(value - 273, 2)
         return responses
 
-    def get_status(self):
-        requests = {
-            "cycles": ("14", 1),
-        }
-        responses = self._read_bulk(requests)
+    def get_status(self, response_data=None):
+        responses = self._read_bulk(self.STATUS_REGISTERS, response_data=response_data)
 
         for key, value in responses.items():
             if type(responses[key]) is float:
                 responses[key] = int(value)
         return responses
 
-    def get_mosfet_status(self):
-        requests = {
-            "full_capacity_ah": ("11", 1000),
-            "remaining_capacity_ah": ("12", 1000),
-        }
-        responses = self._read_bulk(requests)
+    def get_mosfet_status(self, response_data=None):
+        responses = self._read_bulk(self.MOSFET_REGISTERS, response_data=response_data)
 
         for key, value in responses.items():
             if type(responses[key]) is float:
                 responses[key] = round(value, 2)
 
-        pack_response = self._read("15")
-        if pack_response is False:
+        pack_response = responses.pop("pack_state", None)
+        if pack_response is None:
             return responses
 
-        pack_state = []
-        for key, value in self.PACK_STATUS.items():
-            if pack_response[key] == "1":
-                pack_state.append(value)
-
-        responses['pack_state'] = pack_state
+        responses['pack_state'] = self.PACK_STATES.decode(pack_response)
         return responses
 
-    def get_errors(self):
-        response = self._read("16")
-        pack_state = []
-        for key, value in self.BATTERY_STATUS.items():
-            if response[key] == "1":
-                pack_state.append(value)
+    def get_errors(self, response_data=None):
+        """
+        :param response_data: Raw value of the battery status register (Default: read from the BMS)
+        """
+        if response_data is None:
+            response_data = self._read("16")
+        if response_data is False:
+            return False
+        return self.ALARMS.decode(response_data)
 
-        return pack_state
+    def get_error_mask(self, response_data=None):
+        """
+        :return: Battery status register as int, or False
+        """
+        if response_data is None:
+            response_data = self._read("16")
+        return response_data
 
     # dummy functions for everything that is not supported by the Sinowealth BMS
     def get_cell_voltage_range(self):
@@ -228,14 +553,44 @@ class DalyBMSSinowealth:
         return {}
 
     def get_all(self):
-        return {
-            "soc": self.get_soc(),
-            # "cell_voltage_range": self.get_cell_voltage_range(),
-            # "temperature_range": self.get_temperature_range(),
-            "mosfet_status": self.get_mosfet_status(),
-            "status": self.get_status(),
-            "cell_voltages": self.get_cell_voltages(),
-            "temperatures": self.get_temperatures(),
-            # "balancing_status": self.get_balancing_status(),
-            "errors": self.get_errors()
-        }
+        with polling_cycle(self.retry_policy):
+            cells = self._cell_count()
+            if cells:
+                # all registers in as few round trips as possible
+                return self._parse_snapshot(cells, self._scan(self._snapshot_registers(cells)))
+            return {
+                "soc": self.get_soc(),
+                # "cell_voltage_range": self.get_cell_voltage_range(),
+                # "temperature_range": self.get_temperature_range(),
+                "mosfet_status": self.get_mosfet_status(),
+                "status": self.get_status(),
+                "cell_voltages": self.get_cell_voltages(),
+                "temperatures": self.get_temperatures(),
+                # "balancing_status": self.get_balancing_status(),
+                "errors": self.get_errors()
+            }
+
+    def _stream_fields(self, fields):
+        if fields is None:
+            return None
+        fields = tuple(fields)
+        for field in fields:
+            if field not in self.FIELDS:
+                raise ValueError("unknown field %s, use one of %s" % (field, ", ".join(self.FIELDS)))
+        return fields
+
+    def _read_fields(self, fields):
+        if fields is None:
+            return self.get_all()
+        return {field: getattr(self, "get_%s" % field)() for field in fields}
+
+    def stream(self, interval=1, fields=None):
+        """
+        Reads on fixed deadlines, see DalyBMS.stream
+
+        :param interval: Seconds between the start of two reads (Default: 1)
+        :param fields: Names of the fields to read, see FIELDS (Default: all, read in one scan)
+        :return: Generator of stream.Sample objects, Sample.data is a dict like the result of get_all
+        """
+        fields = self._stream_fields(fields)
+        return stream.poll(lambda: self._read_fields(fields), interval, metrics=self.metrics, device=self.device)
@@ -0,0 +1,275 @@
+"""
+Charged and discharged Ah and Wh integrated from fast SOC readings, see EnergyCounter and EnergyMeter.
+
+The BMS only reports the remaining capacity with a coarse resolution, integrating the current and the power of
+frequent readings is much more precise for short periods and small currents.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from . import stream
+from .retry_policy import polling_cycle
+
+
+class EnergyCounter:
+    """
+    Integrates current and power with the trapezoidal rule. An interval in which the current changes its direction
+    gets split at the zero crossing, so that charge and discharge are counted separately. Intervals longer than
+    'max_gap' seconds, e.g. after failed reads, are not integrated.
+    """
+
+    def __init__(self, max_gap=5):
+        """
+
+        :param max_gap: Longest interval between two readings in seconds that gets integrated (Default: 5)
+        """
+        self.max_gap = max_gap
+        self.charge_ah = 0.0
+        self.discharge_ah = 0.0
+        self.charge_wh = 0.0
+        self.discharge_wh = 0.0
+        self.samples = 0
+        self.seconds = 0.0  # integrated time
+        self.gaps = 0
+        self.updated = None  # unix timestamp of the last reading
+        self.last = None  # (monotonic time, voltage, current) of the last reading
+
+    @property
+    def net_ah(self):
+        """
+        Charged minus discharged Ah
+        """
+        return self.charge_ah - self.discharge_ah
+
+    @property
+    def net_wh(self):
+        """
+        Charged minus discharged Wh
+        """
+        return self.charge_wh - self.discharge_wh
+
+    def add(self, total_voltage, current, timestamp=None):
+        """
+        :param total_voltage: Pack voltage in V
+        :param current: Current in A, negative=charging, positive=discharging like in get_soc
+        :param timestamp: Monotonic time of the reading in seconds (Default: time.monotonic())
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        last = self.last
+        self.last = (timestamp, total_voltage, current)
+        self.samples += 1
+        self.updated = time.time()
+        if last is None:
+            return
+        elapsed = timestamp - last[0]
+        if elapsed <= 0:
+            return
+        if elapsed > self.max_gap:
+            self.gaps += 1
+            return
+        self.seconds += elapsed
+        _, last_voltage, last_current = last
+        if last_current * current < 0:
+            # split at the zero crossing
+            share = last_current / (last_current - current)
+            voltage = last_voltage + (total_voltage - last_voltage) * share
+            self._segment(elapsed * share, last_voltage, last_current, voltage, 0.0)
+            self._segment(elapsed * (1 - share), voltage, 0.0, total_voltage, current)
+        else:
+            self._segment(elapsed, last_voltage, last_current, total_voltage, current)
+
+    def add_soc(self, soc, timestamp=None):
+        """
+        :param soc: Result of get_soc or get_power, a records.Soc object, or False for a failed read, which is
+                    ignored like a result without voltage or current
+        :return: True if the reading was used
+        """
+        if not soc:
+            return False
+        if isinstance(soc, dict):
+            total_voltage, current = soc.get("total_voltage"), soc.get("current")
+        else:
+            total_voltage, current = soc.total_voltage, soc.current
+        if total_voltage is None or current is None:
+            return False
+        self.add(total_voltage, current, timestamp)
+        return True
+
+    def _segment(self, elapsed, voltage1, current1, voltage2, current2):
+        # both currents have the same sign here
+        ah = (current1 + current2) / 2 * elapsed / 3600
+        wh = (voltage1 * current1 + voltage2 * current2) / 2 * elapsed / 3600
+        if ah < 0:
+            self.charge_ah -= ah
+            self.charge_wh -= wh
+        else:
+            self.discharge_ah += ah
+            self.discharge_wh += wh
+
+    def reset(self):
+        self.charge_ah = self.discharge_ah = self.charge_wh = self.discharge_wh = 0.0
+        self.samples = 0
+        self.seconds = 0.0
+        self.gaps = 0
+
+    def to_dict(self):
+        return {
+            "charge_ah": self.charge_ah,
+            "discharge_ah": self.discharge_ah,
+            "net_ah": self.net_ah,
+            "charge_wh": self.charge_wh,
+            "discharge_wh": self.discharge_wh,
+            "net_wh": self.net_wh,
+            "samples": self.samples,
+            "seconds": self.seconds,
+            "gaps": self.gaps,
+            "updated": self.updated,
+        }
+
+    def load(self, path):
+        """
+        Restores the counters saved by save(), a missing file is ignored. The time between the last reading
+        before saving and the first one after loading is never integrated.
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        for key in ("charge_ah", "discharge_ah", "charge_wh", "discharge_wh", "seconds"):
+            setattr(self, key, float(state.get(key, 0)))
+        self.samples = int(state.get("samples", 0))
+        self.gaps = int(state.get("gaps", 0))
+        self.updated = state.get("updated")
+        self.last = None
+        return True
+
+    def save(self, path):
+        # write to a temporary file first, so that an interrupted run doesn't leave broken counters behind
+        temp_path = "%s.tmp" % path
+        with open(temp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+
+class EnergyMeter:
+    """
+    Reads only the voltage and current back to back and feeds the readings into an EnergyCounter: the SOC frame
+    (command 0x90) of Daly, or the voltage and current registers of Sinowealth in one round trip (get_power).
+    The counters get saved every 'save_interval' seconds and when stopping.
+    """
+
+    def __init__(self, bms, path=None, interval=0, save_interval=60, max_gap=5, failure_delay=1, logger=None):
+        """
+
+        :param bms: Connected BMS object, async ones have to be run with run_async
+        :param path: File that keeps the counters, loaded at the start (Default: None, not saved)
+        :param interval: Minimum seconds between the start of two reads, 0 reads as fast as the link allows
+                         (Default: 0)
+        :param save_interval: Seconds between two saves of the counters (Default: 60)
+        :param max_gap: Longest interval between two readings in seconds that gets integrated (Default: 5)
+        :param failure_delay: Seconds to wait after a failed read, at least 'interval' (Default: 1)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.bms = bms
+        self.path = path
+        self.interval = interval
+        self.save_interval = save_interval
+        self.failure_delay = max(failure_delay, interval)
+        # Sinowealth has the voltage and current in separate registers, Daly in the SOC frame
+        self.read = getattr(bms, "get_power", bms.get_soc)
+        self.counter = EnergyCounter(max_gap=max_gap)
+        if path:
+            self.counter.load(path)
+        self.failures = 0
+        self._next_save = None
+
+    def _sample(self, soc, start, end):
+        """
+        :return: False if the read failed
+        """
+        # the reading is assigned to the middle of the request
+        if self.counter.add_soc(soc, (start + end) / 2):
+            return True
+        self.failures += 1
+        self.logger.debug("SOC read failed, waiting %.1f seconds", self.failure_delay)
+        return False
+
+    def _save_due(self, now):
+        if self._next_save is None:
+            self._next_save = now + self.save_interval
+        if now < self._next_save:
+            return False
+        self._next_save = now + self.save_interval
+        self.save()
+        return True
+
+    def save(self):
+        if self.path:
+            self.counter.save(self.path)
+
+    def run(self, duration=None, callback=None):
+        """
+        Reads until 'duration' seconds passed or the process gets interrupted
+
+        :param duration: Seconds to run, None runs forever (Default: None)
+        :param callback: Function (EnergyCounter) called after every save (Default: None)
+        :return: EnergyCounter
+        """
+        schedule = stream.Schedule(self.interval) if self.interval else None
+        end_time = None if duration is None else time.monotonic() + duration
+        try:
+            while end_time is None or time.monotonic() < end_time:
+                if schedule:
+                    wait, _ = schedule.next(time.monotonic())
+                    if wait:
+                        time.sleep(wait)
+                    schedule.advance()
+                start = time.monotonic()
+                # the fast path must never be answered from the cache, every read is a polling cycle of its own
+                with self.bms.fresh(), polling_cycle(self.bms.retry_policy):
+                    soc = self.read()
+                now = time.monotonic()
+                if not self._sample(soc, start, now):
+                    time.sleep(self.failure_delay)
+                if self._save_due(now) and callback:
+                    callback(self.counter)
+        finally:
+            self.save()
+        return self.counter
+
+    async def run_async(self, duration=None, callback=None):
+        """
+        Same as run, for AsyncDalyBMS, AsyncDalyBMSSinowealth and DalyBMSBluetooth
+        """
+        loop = asyncio.get_running_loop()
+        schedule = stream.Schedule(self.interval) if self.interval else None
+        end_time = None if duration is None else loop.time() + duration
+        try:
+            while end_time is None or loop.time() < end_time:
+                if schedule:
+                    wait, _ = schedule.next(loop.time())
+                    if wait:
+                        await asyncio.sleep(wait)
+                    schedule.advance()
+                start = loop.time()
+                with self.bms.fresh(), polling_cycle(self.bms.retry_policy):
+                    soc = await self.read()
+                now = loop.time()
+                if not self._sample(soc, start, now):
+                    await asyncio.sleep(self.failure_delay)
+                if self._save_due(now) and callback:
+                    callback(self.counter)
+        finally:
+            self.save()
+        return self.counter
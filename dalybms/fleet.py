@@ -0,0 +1,260 @@
+"""
+Polls many BMS, each on its own serial adapter, in parallel on a bounded thread pool, see FleetCollector.
+
+The devices are described in a JSON file:
+    {
+        "workers": 8,
+        "interval": 10,
+        "devices": [
+            {"name": "pack1", "port": "/dev/ttyUSB0"},
+            {"name": "pack2", "port": "/dev/ttyUSB1", "protocol": "daly", "address": 8, "retries": 3,
+             "retry_policy": {"dead_after": 2}},
+            {"name": "pack3", "port": "/dev/ttyUSB2", "protocol": "sinowealth", "retry_policy": true}
+        ]
+    }
+"""
+import json
+import logging
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from . import stream
+from .daly_bms import DalyBMS
+from .daly_sinowealth import DalyBMSSinowealth
+from .retry_policy import AdaptiveRetryPolicy
+
+PROTOCOLS = ("daly", "sinowealth")
+
+
+class DeviceConfig:
+    __slots__ = ("name", "port", "protocol", "address", "retries", "retry_policy", "method")
+
+    def __init__(self, name, port, protocol="daly", address=4, retries=3, retry_policy=None, method="get_all"):
+        """
+
+        :param name: Unique name of the BMS in the output
+        :param port: Serial device, e.g. /dev/ttyUSB0
+        :param protocol: "daly" or "sinowealth" (Default: daly)
+        :param address: Source address of the Daly protocol, 4 for RS485 and 8 for UART (Default: 4)
+        :param retries: How often read requests get repeated (Default: 3)
+        :param retry_policy: Dict of AdaptiveRetryPolicy arguments, True for the defaults,
+                             None for fixed timeouts (Default: None)
+        :param method: Method of the BMS that gets called on every poll (Default: get_all)
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError("%s: unknown protocol %s, use one of %s" % (name, protocol, ", ".join(PROTOCOLS)))
+        self.name = name
+        self.port = port
+        self.protocol = protocol
+        self.address = address
+        self.retries = retries
+        self.retry_policy = retry_policy
+        self.method = method
+
+    def create_bms(self, logger=None, metrics=None):
+        policy = None
+        if self.retry_policy is True:
+            policy = AdaptiveRetryPolicy()
+        elif self.retry_policy:
+            policy = AdaptiveRetryPolicy(**self.retry_policy)
+        if self.protocol == "sinowealth":
+            return DalyBMSSinowealth(request_retries=self.retries, logger=logger, metrics=metrics,
+                                     retry_policy=policy)
+        return DalyBMS(request_retries=self.retries, address=self.address, logger=logger, metrics=metrics,
+                       retry_policy=policy)
+
+
+def load_config(path):
+    """
+    :param path: Path of the JSON file, see the module docstring
+    :return: Dict with the list of DeviceConfig objects under "devices" and the other settings
+    """
+    with open(path) as f:
+        config = json.load(f)
+    devices = []
+    names = set()
+    for entry in config.get("devices", []):
+        entry = dict(entry)
+        entry.setdefault("name", entry.get("port"))
+        device = DeviceConfig(**entry)
+        if device.name in names:
+            raise ValueError("duplicate device name %s" % device.name)
+        names.add(device.name)
+        devices.append(device)
+    config["devices"] = devices
+    return config
+
+
+class _Device:
+    def __init__(self, config):
+        self.config = config
+        self.bms = None
+        self.failures = 0
+        self.next_attempt = 0
+        self.future = None
+
+
+class FleetCollector:
+    """
+    Polls every device once per interval on a thread pool. Every device has its own BMS object and is polled by
+    at most one worker at a time, a device whose previous poll is still running gets skipped. A device that fails
+    gets disconnected and reconnected with an exponential backoff, without taking a worker while it waits.
+    """
+
+    def __init__(self, devices, workers=8, interval=10, reconnect_delay=5, max_reconnect_delay=300, metrics=None,
+                 logger=None):
+        """
+
+        :param devices: List of DeviceConfig objects
+        :param workers: Number of threads, i.e. devices that get polled at the same time (Default: 8)
+        :param interval: Seconds between the start of two polling cycles (Default: 10)
+        :param reconnect_delay: Seconds before the first reconnect, doubled after every failure (Default: 5)
+        :param max_reconnect_delay: Upper limit of the reconnect delay in seconds (Default: 300)
+        :param metrics: Metrics object shared by all devices (Default: None)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.devices = [_Device(config) for config in devices]
+        self.interval = interval
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dalybms")
+
+    @classmethod
+    def from_config(cls, path, **kwargs):
+        """
+        :param path: Path of the JSON config file, arguments override its settings
+        """
+        config = load_config(path)
+        for key in ("workers", "interval", "reconnect_delay", "max_reconnect_delay"):
+            if key in config:
+                kwargs.setdefault(key, config[key])
+        return cls(config["devices"], **kwargs)
+
+    def _poll(self, device):
+        """
+        Runs in a worker thread
+
+        :return: Result record
+        """
+        config = device.config
+        timestamp = time.time()
+        start = time.monotonic()
+        try:
+            if device.bms is None:
+                bms = config.create_bms(logger=self.logger, metrics=self.metrics)
+                bms.connect(config.port)
+                device.bms = bms
+            data = getattr(device.bms, config.method)()
+        except Exception as e:
+            self.logger.warning("%s: %s", config.name, e)
+            self._failed(device)
+            return self._record(device, timestamp, time.monotonic() - start, error=str(e))
+        device.failures = 0
+        return self._record(device, timestamp, time.monotonic() - start, data=data)
+
+    def _failed(self, device):
+        # a new connection next time, e.g. after the adapter got replugged
+        if device.bms is not None:
+            try:
+                device.bms.disconnect()
+            except Exception as e:
+                self.logger.debug("%s: disconnect failed: %s", device.config.name, e)
+            device.bms = None
+        device.failures += 1
+        delay = min(self.reconnect_delay * 2 ** (device.failures - 1), self.max_reconnect_delay)
+        device.next_attempt = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _record(device, timestamp, duration, data=None, error=None):
+        if hasattr(data, "to_dict"):
+            data = data.to_dict()
+        return {
+            "timestamp": timestamp,
+            "device": device.config.name,
+            "port": device.config.port,
+            "duration": duration,
+            "data": data,
+            "error": error,
+        }
+
+    def _start_cycle(self):
+        """
+        :return: Records of the devices that wait for a reconnect
+        """
+        records = []
+        now = time.monotonic()
+        for device in self.devices:
+            if device.future is not None:
+                self.logger.warning("%s: previous poll still running, skipped", device.config.name)
+            elif device.bms is None and device.next_attempt > now:
+                records.append(self._record(device, time.time(), 0,
+                                            error="reconnecting in %.0f seconds" % (device.next_attempt - now)))
+            else:
+                device.future = self.executor.submit(self._poll, device)
+        return records
+
+    def _finished(self, timeout):
+        """
+        Waits up to 'timeout' seconds for running polls
+
+        :return: Records of the polls that finished
+        """
+        futures = {device.future: device for device in self.devices if device.future is not None}
+        if not futures:
+            if timeout:
+                time.sleep(timeout)
+            return []
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        records = []
+        for future in done:
+            futures[future].future = None
+            records.append(future.result())
+        return records
+
+    def collect(self, cycles=None):
+        """
+        Generator of result records in the order the polls finish, a slow device doesn't delay the others.
+        A record is a dict with the timestamp of the start of the poll, the device name and port, the duration,
+        the data returned by the BMS method or None and an error message or None.
+
+        :param cycles: Number of polling cycles, None runs forever (Default: None)
+        """
+        schedule = stream.Schedule(self.interval)
+        count = 0
+        while cycles is None or count < cycles:
+            wait_time, missed = schedule.next(time.monotonic())
+            while wait_time > 0:
+                yield from self._finished(wait_time)
+                wait_time, missed = schedule.next(time.monotonic())
+            if missed:
+                self.logger.warning("skipped %i polling cycles", missed)
+            yield from self._start_cycle()
+            schedule.advance()
+            count += 1
+        # the polls of the last cycle
+        while any(device.future is not None for device in self.devices):
+            yield from self._finished(None)
+
+    def poll_all(self):
+        """
+        Polls all devices once
+
+        :return: Dict of device name -> result record
+        """
+        return {record["device"]: record for record in self.collect(cycles=1)}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for device in self.devices:
+            if device.bms is not None:
+                try:
+                    device.bms.disconnect()
+                except Exception as e:
+                    self.logger.debug("%s: disconnect failed: %s", device.config.name, e)
+                device.bms = None
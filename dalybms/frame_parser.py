@@ -0,0 +1,89 @@
+import logging
+
+
+class DalyFrameParser:
+    """
+    Splits a byte stream into response frames of the Daly protocol:
+    start byte (0xA5), address, command, data length (8), 8 data bytes and a checksum.
+
+    Bytes in front of a start byte get dropped. When the length or the checksum of a frame is wrong,
+    only its start byte gets dropped and the parser resynchronizes on the next start byte,
+    so a single stray byte doesn't shift all following frames.
+    """
+    START_BYTE = 0xA5
+    DATA_LENGTH = 8
+    FRAME_LENGTH = 13
+
+    def __init__(self, strict_crc=True, logger=None):
+        """
+
+        :param strict_crc: Drop frames with a checksum mismatch (Default: True)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.strict_crc = strict_crc
+        self.buffer = bytearray()
+        self.dropped_bytes = 0
+        self.crc_errors = 0
+        self.corrupt_commands = []  # command bytes of the frames dropped because of a checksum mismatch
+
+    def reset(self):
+        self.buffer.clear()
+
+    @property
+    def bytes_needed(self):
+        """
+        Number of bytes that are at least missing to complete the next frame
+        """
+        if self.buffer and self.buffer[0] == self.START_BYTE:
+            return max(self.FRAME_LENGTH - len(self.buffer), 1)
+        return self.FRAME_LENGTH
+
+    def feed(self, data):
+        """
+        Adds received bytes and returns all frames that are complete now
+
+        :param data: Received bytes
+        :return: List of complete frames as bytes
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(self.START_BYTE)
+            if start == -1:
+                self._drop(len(self.buffer))
+                break
+            if start > 0:
+                self._drop(start)
+            if len(self.buffer) < self.FRAME_LENGTH:
+                break
+
+            if self.buffer[3] != self.DATA_LENGTH:
+                self.logger.debug("invalid data length %i, resynchronizing", self.buffer[3])
+                self._drop(1)
+                continue
+
+            frame = bytes(self.buffer[:self.FRAME_LENGTH])
+            crc = sum(frame[:-1]) & 0xFF
+            if crc != frame[-1]:
+                self.crc_errors += 1
+                self.logger.debug("response crc mismatch: %02x != %02x in %s", crc, frame[-1], frame.hex())
+                if self.strict_crc:
+                    self.corrupt_commands.append(frame[2])
+                    self._drop(1)
+                    continue
+
+            del self.buffer[:self.FRAME_LENGTH]
+            frames.append(frame)
+        return frames
+
+    def _drop(self, length):
+        if not length:
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("dropping %s", self.buffer[:length].hex())
+        self.dropped_bytes += length
+        del self.buffer[:length]
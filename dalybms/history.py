@@ -0,0 +1,183 @@
+import math
+import time
+from array import array
+
+NAN = float("nan")
+
+
+class History:
+    """
+    Keeps the values of recent snapshots at full resolution in a ring buffer and rolls them up into
+    min/max/mean buckets of coarser resolutions. All buffers get allocated up front, so the memory usage
+    stays the same no matter how long the poller runs.
+    """
+
+    # field name -> (section of the get_all result, key)
+    FIELDS = {
+        "total_voltage": ("soc", "total_voltage"),
+        "current": ("soc", "current"),
+        "soc_percent": ("soc", "soc_percent"),
+        "highest_voltage": ("cell_voltage_range", "highest_voltage"),
+        "lowest_voltage": ("cell_voltage_range", "lowest_voltage"),
+        "highest_temperature": ("temperature_range", "highest_temperature"),
+        "lowest_temperature": ("temperature_range", "lowest_temperature"),
+    }
+
+    def __init__(self, size=3600, resolutions=((60, 1440), (900, 2880)), fields=None):
+        """
+
+        :param size: Number of snapshots kept at full resolution (Default: 3600)
+        :param resolutions: Pairs of (seconds per bucket, number of buckets) for the rolled up values
+                            (Default: 1 minute buckets for 24 hours, 15 minute buckets for 30 days)
+        :param fields: Dict of field name -> (section, key), see FIELDS (Default: FIELDS)
+        """
+        self.fields = fields or self.FIELDS
+        self.size = size
+        self.timestamps = array("d", [NAN]) * size
+        self.values = {field: array("d", [NAN]) * size for field in self.fields}
+        self.position = 0
+        self.tiers = [_Tier(resolution, buckets, self.fields) for resolution, buckets in resolutions]
+
+    def add(self, data, timestamp=None):
+        """
+        Adds a snapshot
+
+        :param data: Result of get_all or get_snapshot, sections that failed are stored as NaN
+        :param timestamp: Unix timestamp of the snapshot (Default: now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        index = self.position % self.size
+        self.timestamps[index] = timestamp
+        for field, (section, key) in self.fields.items():
+            value = self._extract(data, section, key)
+            self.values[field][index] = value
+            if not math.isnan(value):
+                for tier in self.tiers:
+                    tier.add(timestamp, field, value)
+        self.position += 1
+
+    @staticmethod
+    def _extract(data, section, key):
+        if isinstance(data, dict):
+            section_data = data.get(section)
+        else:
+            section_data = getattr(data, section, None)
+        if not section_data:
+            return NAN
+        if isinstance(section_data, dict):
+            value = section_data.get(key)
+        else:
+            value = getattr(section_data, key, None)
+        if value is None:
+            return NAN
+        return float(value)
+
+    def oldest_timestamp(self):
+        """
+        :return: Timestamp of the oldest snapshot that is still kept at full resolution, or None
+        """
+        if self.position == 0:
+            return None
+        if self.position < self.size:
+            return self.timestamps[0]
+        return self.timestamps[self.position % self.size]
+
+    def samples(self, since=0, until=math.inf):
+        """
+        Snapshots at full resolution
+
+        :return: List of dicts with "time" and one value per field
+        """
+        result = []
+        first = max(self.position - self.size, 0)
+        for position in range(first, self.position):
+            index = position % self.size
+            timestamp = self.timestamps[index]
+            if since <= timestamp <= until:
+                sample = {"time": timestamp}
+                for field in self.fields:
+                    sample[field] = self.values[field][index]
+                result.append(sample)
+        return result
+
+    def query(self, since, until=None):
+        """
+        Returns the values since a point in time, at full resolution if they are still available,
+        otherwise as buckets of the finest resolution that reaches back far enough.
+
+        :param since: Unix timestamp
+        :param until: Unix timestamp (Default: now)
+        :return: List of dicts with "time" and one value per field, for buckets the values are
+                 dicts with "min", "max" and "mean"
+        """
+        if until is None:
+            until = time.time()
+        oldest = self.oldest_timestamp()
+        if oldest is not None and oldest <= since:
+            return self.samples(since, until)
+        for tier in self.tiers:
+            if tier.covers(since, until):
+                return tier.buckets(since, until)
+        if self.tiers:
+            return self.tiers[-1].buckets(since, until)
+        return self.samples(since, until)
+
+
+class _Tier:
+    """
+    Ring buffer of aggregated buckets, the slot of a bucket is its number modulo the number of buckets,
+    so old buckets get overwritten without any extra bookkeeping.
+    """
+
+    def __init__(self, resolution, size, fields):
+        self.resolution = resolution
+        self.size = size
+        self.starts = array("d", [NAN]) * size
+        self.minimum = {field: array("d", [NAN]) * size for field in fields}
+        self.maximum = {field: array("d", [NAN]) * size for field in fields}
+        self.total = {field: array("d", [0.0]) * size for field in fields}
+        self.count = {field: array("L", [0]) * size for field in fields}
+
+    def add(self, timestamp, field, value):
+        bucket = int(timestamp // self.resolution)
+        index = bucket % self.size
+        start = bucket * self.resolution
+        if self.starts[index] != start:
+            self.starts[index] = start
+            for name in self.count:
+                self.minimum[name][index] = NAN
+                self.maximum[name][index] = NAN
+                self.total[name][index] = 0.0
+                self.count[name][index] = 0
+        if self.count[field][index] == 0:
+            self.minimum[field][index] = value
+            self.maximum[field][index] = value
+        else:
+            self.minimum[field][index] = min(self.minimum[field][index], value)
+            self.maximum[field][index] = max(self.maximum[field][index], value)
+        self.total[field][index] += value
+        self.count[field][index] += 1
+
+    def covers(self, since, until):
+        return until - since <= self.resolution * self.size
+
+    def buckets(self, since, until):
+        result = []
+        first = int(since // self.resolution)
+        last = int(until // self.resolution)
+        for bucket in range(max(first, last - self.size + 1), last + 1):
+            index = bucket % self.size
+            start = bucket * self.resolution
+            if self.starts[index] != start:
+                continue
+            entry = {"time": start}
+            for field in self.count:
+                count = self.count[field][index]
+                entry[field] = {
+                    "min": self.minimum[field][index],
+                    "max": self.maximum[field][index],
+                    "mean": self.total[field][index] / count if count else NAN,
+                }
+            result.append(entry)
+        return result
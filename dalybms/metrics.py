@@ -0,0 +1,184 @@
+"""
+Counters and latency histograms of the bus and parser health, exposed in the Prometheus text format.
+
+Attach a Metrics object to a BMS with DalyBMS(metrics=...), several BMS can share one.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help)
+METRICS = {
+    "dalybms_requests_total": ("counter", "Read requests, retries of a request are not counted"),
+    "dalybms_retries_total": ("counter", "Repeated read requests"),
+    "dalybms_failures_total": ("counter", "Read requests that failed after all retries"),
+    "dalybms_timeouts_total": ("counter", "Reads that ended with response frames missing"),
+    "dalybms_crc_errors_total": ("counter", "Response frames dropped because of a checksum mismatch"),
+    "dalybms_dropped_bytes_total": ("counter", "Received bytes that were not part of a valid frame"),
+    "dalybms_out_of_order_frames_total": ("counter", "Multi frame responses with a missing or wrong frame number"),
+    "dalybms_missed_deadlines_total": ("counter", "Stream deadlines skipped because a read took too long"),
+    "dalybms_request_duration_seconds": ("histogram", "Duration of read requests including retries"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+
+        :param buckets: Upper bounds of the histogram buckets in seconds (Default: DEFAULT_BUCKETS)
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def inc(self, name, labels, value=1):
+        """
+        :param name: Name of the counter, see METRICS
+        :param labels: Dict of label name -> value
+        :param value: Increment (Default: 1)
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        :param name: Name of the histogram, see METRICS
+        :param labels: Dict of label name -> value
+        :param value: Observed value in seconds
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # bucket counts, sum, count
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def count(self, name, device, command=None, value=1):
+        """
+        Increments a counter of a device and optionally a command
+        """
+        labels = {"device": device or ""}
+        if command is not None:
+            labels["command"] = command
+        self.inc(name, labels, value)
+
+    def request(self, device, command, duration, tries, success):
+        """
+        Records a read request
+
+        :param device: Serial device or MAC address of the BMS
+        :param command: Command ID or register
+        :param duration: Seconds from the first try until the response or the last failed try
+        :param tries: Number of tries including the successful one
+        :param success: Whether a response arrived
+        """
+        labels = {"device": device or "", "command": command}
+        self.inc("dalybms_requests_total", labels)
+        if tries > 1:
+            self.inc("dalybms_retries_total", labels, tries - 1)
+        if not success:
+            self.inc("dalybms_failures_total", labels)
+        self.observe("dalybms_request_duration_seconds", labels, duration)
+
+    def receive(self, device, parser, requests, responses):
+        """
+        Records the frame errors of a DalyFrameParser and the commands whose response frames did not all arrive
+
+        :param requests: Dict of command ID -> number of expected response frames
+        :param responses: Dict of command ID -> list of received response data
+        """
+        if parser.crc_errors:
+            self.count("dalybms_crc_errors_total", device, value=parser.crc_errors)
+        if parser.dropped_bytes:
+            self.count("dalybms_dropped_bytes_total", device, value=parser.dropped_bytes)
+        for command, expected in requests.items():
+            if len(responses[command]) < expected:
+                self.count("dalybms_timeouts_total", device, command)
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for name, (metric_type, description) in METRICS.items():
+                if metric_type == "counter":
+                    samples = [(key[1], value) for key, value in self.counters.items() if key[0] == name]
+                else:
+                    samples = [(key[1], value) for key, value in self.histograms.items() if key[0] == name]
+                if not samples:
+                    continue
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                for labels, value in sorted(samples):
+                    if metric_type == "counter":
+                        lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+                        continue
+                    bucket_counts, total, count = value
+                    for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts + [count]):
+                        bucket_labels = labels + (("le", _format_value(bound)),)
+                        lines.append("%s_bucket%s %i" % (name, _format_labels(bucket_labels), bucket_count))
+                    lines.append("%s_sum%s %s" % (name, _format_labels(labels), repr(total)))
+                    lines.append("%s_count%s %i" % (name, _format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9101, address=""):
+        """
+        Serves the metrics on http://address:port/metrics from a background thread
+
+        :param port: TCP port (Default: 9101)
+        :param address: Address to listen on (Default: all addresses)
+        :return: ThreadingHTTPServer object
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.server
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
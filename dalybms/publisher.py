@@ -0,0 +1,129 @@
+import json
+import math
+import os
+import time
+
+
+class ChangePublisher:
+    """
+    Publishes only the values of a result that changed by more than their deadband since they were last sent,
+    and every value again after 'refresh_interval' seconds, so that subscribers still see the BMS alive.
+    Home Assistant discovery configs are sent once per field and broker.
+
+    The state can be kept in a file, so that it survives between runs of daly-bms-cli.
+    """
+
+    def __init__(self, send, send_discovery=None, deadbands=None, refresh_interval=300, broker=None):
+        """
+
+        :param send: Function (base, value) that publishes a value, base is the path of the value, e.g. /soc/current
+        :param send_discovery: Function (base) that publishes the discovery config of a value (Default: None)
+        :param deadbands: Dict of path or key -> minimum change of a numeric value, e.g. {"current": 0.1,
+                          "cell_voltages": 0.005}. The most specific match wins, the default is 0.
+        :param refresh_interval: Seconds after which unchanged values get sent again (Default: 300)
+        :param broker: Identifier of the broker, e.g. host:port, the discovery configs get sent again
+                       when it changes (Default: None)
+        """
+        self.send = send
+        self.send_discovery = send_discovery
+        self.deadbands = deadbands or {}
+        self.refresh_interval = refresh_interval
+        self.broker = broker
+        self.sent = {}  # base -> (value, timestamp)
+        self.discovered = set()
+
+    def new_session(self, broker=None):
+        """
+        Forgets which discovery configs got sent, e.g. after connecting to another broker
+        """
+        self.broker = broker
+        self.discovered = set()
+
+    def deadband(self, base):
+        """
+        :param base: Path of the value, e.g. /cell_voltages/3
+        :return: Deadband of the full path or of the closest key on the path
+        """
+        parts = base.strip("/").split("/")
+        path = "/".join(parts)
+        if path in self.deadbands:
+            return self.deadbands[path]
+        for key in reversed(parts):
+            if key in self.deadbands:
+                return self.deadbands[key]
+        return 0
+
+    def changed(self, base, value, now):
+        last = self.sent.get(base)
+        if last is None:
+            return True
+        last_value, timestamp = last
+        if now - timestamp >= self.refresh_interval:
+            return True
+        numeric = (int, float)
+        if isinstance(value, numeric) and isinstance(last_value, numeric) \
+                and not isinstance(value, bool) and not isinstance(last_value, bool):
+            if math.isnan(value) or math.isnan(last_value):
+                return not (math.isnan(value) and math.isnan(last_value))
+            return abs(value - last_value) > self.deadband(base)
+        return value != last_value
+
+    def publish(self, result, base="", now=None):
+        """
+        :param result: Result of a get_* call, nested dicts get published as one value per key,
+                       lists like the result of get_errors as one value
+        :param base: Path of the result, e.g. /errors for a list (Default: "")
+        :param now: Unix timestamp (Default: now)
+        :return: Number of sent values
+        """
+        if now is None:
+            now = time.time()
+        count = 0
+        if isinstance(result, list):
+            return self._publish_value(base, result, now)
+        if not isinstance(result, dict):
+            # e.g. False for a failed request
+            return 0
+        for key, value in result.items():
+            if isinstance(value, dict):
+                count += self.publish(value, base="%s/%s" % (base, key), now=now)
+            else:
+                count += self._publish_value("%s/%s" % (base, key), value, now)
+        return count
+
+    def _publish_value(self, base, value, now):
+        if self.send_discovery and base not in self.discovered:
+            self.send_discovery(base)
+            self.discovered.add(base)
+        if not self.changed(base, value, now):
+            return 0
+        self.send(base, value)
+        self.sent[base] = (value, now)
+        return 1
+
+    def load(self, path):
+        """
+        Restores the state saved by save(), a missing or unreadable file is ignored
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get("broker") != self.broker:
+            return False
+        self.sent = {base: (value, timestamp) for base, (value, timestamp) in state.get("sent", {}).items()}
+        self.discovered = set(state.get("discovered", []))
+        return True
+
+    def save(self, path):
+        state = {
+            "broker": self.broker,
+            "sent": self.sent,
+            "discovered": sorted(self.discovered),
+        }
+        # write to a temporary file first, so that an interrupted run doesn't leave a broken state behind
+        temp_path = "%s.tmp" % path
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, path)
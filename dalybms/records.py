@@ -0,0 +1,247 @@
+"""
+Compact records for the responses of the Daly protocol.
+
+The records use __slots__ and keep cell voltages and temperatures in arrays, so a snapshot needs a fraction of
+the memory of the nested dicts returned by the getters. to_dict() returns the same structure as the getters.
+"""
+from array import array
+
+from . import codec
+from .alarms import DALY_ALARMS
+
+
+class Soc:
+    __slots__ = ("total_voltage", "current", "soc_percent")
+
+    def __init__(self, total_voltage, current, soc_percent):
+        self.total_voltage = total_voltage
+        self.current = current  # negative=charging, positive=discharging
+        self.soc_percent = soc_percent
+
+    @classmethod
+    def from_response(cls, response_data):
+        parts = codec.SOC.unpack_from(response_data)
+        # parts[1] is always 0
+        return cls(parts[0] / 10, (parts[2] - 30000) / 10, parts[3] / 10)
+
+    def to_dict(self):
+        return {
+            "total_voltage": self.total_voltage,
+            "current": self.current,
+            "soc_percent": self.soc_percent
+        }
+
+
+class CellVoltageRange:
+    __slots__ = ("highest_voltage", "highest_cell", "lowest_voltage", "lowest_cell")
+
+    def __init__(self, highest_voltage, highest_cell, lowest_voltage, lowest_cell):
+        self.highest_voltage = highest_voltage
+        self.highest_cell = highest_cell
+        self.lowest_voltage = lowest_voltage
+        self.lowest_cell = lowest_cell
+
+    @classmethod
+    def from_response(cls, response_data):
+        parts = codec.CELL_VOLTAGE_RANGE.unpack_from(response_data)
+        return cls(parts[0] / 1000, parts[1], parts[2] / 1000, parts[3])
+
+    def to_dict(self):
+        return {
+            "highest_voltage": self.highest_voltage,
+            "highest_cell": self.highest_cell,
+            "lowest_voltage": self.lowest_voltage,
+            "lowest_cell": self.lowest_cell,
+        }
+
+
+class TemperatureRange:
+    __slots__ = ("highest_temperature", "highest_sensor", "lowest_temperature", "lowest_sensor")
+
+    def __init__(self, highest_temperature, highest_sensor, lowest_temperature, lowest_sensor):
+        self.highest_temperature = highest_temperature
+        self.highest_sensor = highest_sensor
+        self.lowest_temperature = lowest_temperature
+        self.lowest_sensor = lowest_sensor
+
+    @classmethod
+    def from_response(cls, response_data):
+        parts = codec.TEMPERATURE_RANGE.unpack_from(response_data)
+        return cls(parts[0] - 40, parts[1], parts[2] - 40, parts[3])
+
+    def to_dict(self):
+        return {
+            "highest_temperature": self.highest_temperature,
+            "highest_sensor": self.highest_sensor,
+            "lowest_temperature": self.lowest_temperature,
+            "lowest_sensor": self.lowest_sensor,
+        }
+
+
+class MosfetStatus:
+    __slots__ = ("mode", "charging_mosfet", "discharging_mosfet", "capacity_ah")
+
+    MODES = ("stationary", "charging", "discharging")
+
+    def __init__(self, mode, charging_mosfet, discharging_mosfet, capacity_ah):
+        self.mode = mode
+        self.charging_mosfet = charging_mosfet
+        self.discharging_mosfet = discharging_mosfet
+        self.capacity_ah = capacity_ah
+
+    @classmethod
+    def from_response(cls, response_data):
+        parts = codec.MOSFET_STATUS.unpack_from(response_data)
+        # parts[3] would be the cycle count, but the result is unstable
+        mode = cls.MODES[parts[0]] if parts[0] in (0, 1) else cls.MODES[2]
+        return cls(mode, parts[1], parts[2], parts[4] / 1000)
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "charging_mosfet": self.charging_mosfet,
+            "discharging_mosfet": self.discharging_mosfet,
+            "capacity_ah": self.capacity_ah,
+        }
+
+
+class Status:
+    __slots__ = ("cells", "temperature_sensors", "charger_running", "load_running", "state_bits", "cycles")
+
+    def __init__(self, cells, temperature_sensors, charger_running, load_running, state_bits, cycles):
+        self.cells = cells
+        self.temperature_sensors = temperature_sensors
+        self.charger_running = charger_running
+        self.load_running = load_running
+        self.state_bits = state_bits
+        self.cycles = cycles
+
+    @classmethod
+    def from_response(cls, response_data):
+        return cls(*codec.STATUS.unpack_from(response_data))
+
+    @property
+    def states(self):
+        return codec.decode_states(self.state_bits)
+
+    def to_dict(self):
+        return {
+            "cells": self.cells,
+            "temperature_sensors": self.temperature_sensors,
+            "charger_running": self.charger_running,
+            "load_running": self.load_running,
+            "states": self.states,
+            "cycles": self.cycles,
+        }
+
+
+class CellVoltages:
+    """
+    Cell voltages, stored as millivolts. Cell numbers start with 1.
+    """
+    __slots__ = ("millivolts",)
+
+    def __init__(self, millivolts):
+        self.millivolts = array("h", millivolts)
+
+    def __len__(self):
+        return len(self.millivolts)
+
+    def __getitem__(self, cell):
+        return self.millivolts[cell - 1] / 1000
+
+    def to_dict(self):
+        return {cell: value / 1000 for cell, value in enumerate(self.millivolts, start=1)}
+
+
+class Temperatures:
+    """
+    Sensor temperatures in °C. Sensor numbers start with 1.
+    """
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        # the BMS sends the temperature + 40 as signed byte
+        self.raw = array("b", raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, sensor):
+        return self.raw[sensor - 1] - 40
+
+    def to_dict(self):
+        return {sensor: value - 40 for sensor, value in enumerate(self.raw, start=1)}
+
+
+class BalancingStatus:
+    """
+    Balancing state of the cells, bit 0 of the first byte is cell 1. Cell numbers start with 1.
+    """
+    __slots__ = ("mask", "cells")
+
+    def __init__(self, mask, cells):
+        self.mask = mask
+        self.cells = cells
+
+    @classmethod
+    def from_response(cls, response_data, cells):
+        # bytes 6 and 7 are reserved
+        return cls(int.from_bytes(response_data[:6], byteorder='little'), cells)
+
+    def __len__(self):
+        return self.cells
+
+    def __getitem__(self, cell):
+        return bool(self.mask >> (cell - 1) & 1)
+
+    def to_dict(self):
+        return {cell: bool(self.mask >> (cell - 1) & 1) for cell in range(1, self.cells + 1)}
+
+
+class Errors:
+    """
+    Error bits of the battery failure status, bit 0 of the first byte is the first error of ERROR_CODES
+    """
+    __slots__ = ("mask",)
+
+    def __init__(self, mask):
+        self.mask = mask
+
+    @classmethod
+    def from_response(cls, response_data):
+        return cls(int.from_bytes(response_data, byteorder='little'))
+
+    def to_list(self):
+        return DALY_ALARMS.decode(self.mask)
+
+
+class Snapshot:
+    """
+    Result of DalyBMS.get_snapshot, failed reads are False like in get_all
+    """
+    __slots__ = ("soc", "cell_voltage_range", "temperature_range", "mosfet_status", "status", "cell_voltages",
+                 "temperatures", "balancing_status", "errors")
+
+    def __init__(self, soc=False, cell_voltage_range=False, temperature_range=False, mosfet_status=False,
+                 status=False, cell_voltages=False, temperatures=False, balancing_status=False, errors=False):
+        self.soc = soc
+        self.cell_voltage_range = cell_voltage_range
+        self.temperature_range = temperature_range
+        self.mosfet_status = mosfet_status
+        self.status = status
+        self.cell_voltages = cell_voltages
+        self.temperatures = temperatures
+        self.balancing_status = balancing_status
+        self.errors = errors
+
+    def to_dict(self):
+        data = {}
+        for key in self.__slots__:
+            value = getattr(self, key)
+            if isinstance(value, Errors):
+                value = value.to_list()
+            elif hasattr(value, "to_dict"):
+                value = value.to_dict()
+            data[key] = value
+        return data
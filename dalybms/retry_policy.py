@@ -0,0 +1,130 @@
+import random
+from collections import deque
+from contextlib import contextmanager
+
+
+class AdaptiveRetryPolicy:
+    """
+    Learns the reply latency of each command of one BMS and derives the timeout for the first response
+    frame from a rolling percentile. Retries happen right away after the first failure and back off with
+    jitter after repeated failures. After 'dead_after' failed requests in a row the device counts as dead,
+    it gets only one try per request and the rest of a polling cycle is skipped after the first failure.
+    Requests outside of a polling cycle, e.g. a single get_soc, always send that one try, so a device that comes
+    back gets noticed.
+
+    Use one object per BMS, e.g. DalyBMS(retry_policy=AdaptiveRetryPolicy()).
+    """
+
+    def __init__(self, percentile=0.95, window=50, min_samples=5, factor=2.0, minimum=0.05, maximum=None,
+                 backoff=0.2, max_backoff=2.0, dead_after=3, seed=None):
+        """
+
+        :param percentile: Percentile of the recent latencies the timeout is based on (Default: 0.95)
+        :param window: Number of latencies kept per command (Default: 50)
+        :param min_samples: Latencies needed before the timeout gets adapted (Default: 5)
+        :param factor: Timeout = percentile * factor (Default: 2)
+        :param minimum: Lower limit of the timeout in seconds (Default: 0.05)
+        :param maximum: Upper limit of the timeout in seconds (Default: the fixed timeout of the connection)
+        :param backoff: Delay before the second retry in seconds, doubled for every further retry (Default: 0.2)
+        :param max_backoff: Upper limit of the delay in seconds (Default: 2)
+        :param dead_after: Failed requests in a row after which the device counts as dead (Default: 3)
+        :param seed: Seed of the random number generator for the jitter (Default: None)
+        """
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.factor = factor
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_after = dead_after
+        self.random = random.Random(seed)
+        self.latencies = {}
+        self.timeouts = {}
+        self.consecutive_failures = 0
+        self.abandoned = False
+        self.in_cycle = False
+
+    def timeout(self, command, default):
+        """
+        :param command: Command ID or register
+        :param default: Fixed timeout of the connection in seconds
+        :return: Timeout for the first response frame in seconds
+        """
+        maximum = default if self.maximum is None else self.maximum
+        timeout = self.timeouts.get(command)
+        if timeout is None:
+            return maximum
+        return min(max(timeout, self.minimum), maximum)
+
+    def record(self, command, latency):
+        """
+        Adds the time between a request and its first response frame
+        """
+        latencies = self.latencies.get(command)
+        if latencies is None:
+            latencies = self.latencies[command] = deque(maxlen=self.window)
+        latencies.append(latency)
+        if len(latencies) >= self.min_samples:
+            ordered = sorted(latencies)
+            index = min(int(len(ordered) * self.percentile), len(ordered) - 1)
+            self.timeouts[command] = ordered[index] * self.factor
+
+    def tries(self, request_retries):
+        """
+        :return: Number of tries for the next request
+        """
+        if self.dead:
+            return 1
+        return request_retries
+
+    def delay(self, failures):
+        """
+        :param failures: Failed tries of the current request so far
+        :return: Seconds to wait before the next try
+        """
+        if failures < 2:
+            return 0
+        delay = min(self.backoff * 2 ** (failures - 2), self.max_backoff)
+        return delay * self.random.uniform(0.5, 1.0)
+
+    @property
+    def dead(self):
+        return self.consecutive_failures >= self.dead_after
+
+    def start_cycle(self):
+        """
+        Has to be called at the start of a polling cycle, e.g. get_all, see polling_cycle
+        """
+        self.abandoned = False
+        self.in_cycle = True
+
+    def end_cycle(self):
+        self.abandoned = False
+        self.in_cycle = False
+
+    def success(self):
+        self.consecutive_failures = 0
+
+    def failure(self):
+        self.consecutive_failures += 1
+        if self.dead and self.in_cycle:
+            self.abandoned = True
+
+
+@contextmanager
+def polling_cycle(retry_policy):
+    """
+    Wraps the requests of one polling cycle, e.g. get_all
+
+    :param retry_policy: AdaptiveRetryPolicy object or None
+    """
+    if retry_policy is None:
+        yield
+        return
+    retry_policy.start_cycle()
+    try:
+        yield
+    finally:
+        retry_policy.end_cycle()
@@ -0,0 +1,282 @@
+"""
+Simulated BMS on a pseudo terminal, for testing without hardware.
+
+The simulator answers the commands of the Daly protocol (0x90 - 0x98, 0xD9, 0xDA, 0x21, 0x00)
+or the register reads of the Sinowealth protocol and can add latency, jitter, dropped responses and
+checksum errors. Linux/POSIX only.
+"""
+import logging
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+
+class DalyBMSSimulator:
+    def __init__(self, cells=16, temperature_sensors=2, sinowealth=False, baudrate=9600, latency=0.01,
+                 jitter=0.0, drop_rate=0.0, corrupt_rate=0.0, seed=None, logger=None):
+        """
+
+        :param cells: Number of cells (Default: 16, at most 10 for Sinowealth)
+        :param temperature_sensors: Number of temperature sensors (Default: 2)
+        :param sinowealth: Simulate a BMS with Sinowealth chip instead of the Daly protocol (Default: False)
+        :param baudrate: Simulated baud rate for the transfer time of the responses, 0 disables it (Default: 9600)
+        :param latency: Seconds before the BMS starts to respond (Default: 0.01)
+        :param jitter: Maximum of the random seconds added to the latency (Default: 0)
+        :param drop_rate: Share of requests that don't get a response (Default: 0)
+        :param corrupt_rate: Share of response frames with a wrong checksum (Default: 0)
+        :param seed: Seed of the random number generator (Default: None)
+        :param logger: Python Logger object for output (Default: None)
+        """
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.sinowealth = sinowealth
+        if sinowealth:
+            cells = min(cells, 10)
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+
+        self.cell_voltages = [3300 + x for x in range(cells)]  # mV
+        self.temperatures = [20 + x for x in range(temperature_sensors)]  # °C
+        self.current = -1.5  # A, negative=charging
+        self.soc_percent = 87.5
+        self.capacity_ah = 100.0
+        self.cycles = 21
+        self.charging_mosfet = True
+        self.discharging_mosfet = True
+        self.balancing = 0  # bit 0 = cell 1
+        self.errors = 0  # bit 0 of the first byte = first error of ERROR_CODES
+
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.running = False
+        self.requests = 0
+        self.dropped = 0
+        self.corrupted = 0
+
+    def open(self):
+        """
+        Opens the pseudo terminal and starts answering requests in a background thread
+
+        :return: Path of the serial device to connect to
+        """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return os.ttyname(self.slave)
+
+    def close(self):
+        self.running = False
+        # the thread must not write to the file descriptors after they got closed
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = None
+        self.slave = None
+
+    def serve_forever(self):
+        buffer = bytearray()
+        while self.running:
+            master = self.master
+            try:
+                # wake up regularly to notice close()
+                if not select.select([master], [], [], 0.1)[0]:
+                    continue
+                data = os.read(master, 1024)
+            except (OSError, TypeError, ValueError):
+                break
+            if not data:
+                break
+            buffer += data
+            for request in self._split_requests(buffer):
+                self._answer(request)
+
+    def _split_requests(self, buffer):
+        if self.sinowealth:
+            start_byte, length = 0x0A, 3
+        else:
+            start_byte, length = 0xA5, 13
+        requests = []
+        while True:
+            start = buffer.find(start_byte)
+            if start == -1:
+                buffer.clear()
+                break
+            del buffer[:start]
+            if len(buffer) < length:
+                break
+            requests.append(bytes(buffer[:length]))
+            del buffer[:length]
+        return requests
+
+    def _answer(self, request):
+        self.requests += 1
+        self.logger.debug("r %s", request.hex())
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        if self.sinowealth:
+            responses = [self.handle_register(request[1], request[2])]
+        else:
+            if sum(request[:-1]) & 0xFF != request[-1]:
+                self.logger.debug("request crc mismatch")
+                return
+            responses = self.handle_command(request[2], request[4:12])
+        responses = [response for response in responses if response]
+        if not responses:
+            return
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        for response in responses:
+            if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+                self.corrupted += 1
+                response = response[:-1] + bytes([(response[-1] + 1) & 0xFF])
+            if self.baudrate:
+                # 10 bits per byte with start and stop bit
+                time.sleep(len(response) * 10 / self.baudrate)
+            self.logger.debug("w %s", response.hex())
+            # close() may run at the same time and reset self.master
+            master = self.master
+            try:
+                os.write(master, response)
+            except (OSError, TypeError, ValueError):
+                return
+
+    @staticmethod
+    def _frame(command, data):
+        frame = bytearray([0xA5, 0x01, command, 0x08])
+        frame += data.ljust(8, b"\x00")
+        frame.append(sum(frame) & 0xFF)
+        return bytes(frame)
+
+    def _noisy_cell_voltages(self):
+        return [voltage + self.random.randint(-2, 2) for voltage in self.cell_voltages]
+
+    def handle_command(self, command, data):
+        """
+        :param command: Command byte of the request
+        :param data: 8 data bytes of the request
+        :return: List of response frames
+        """
+        cells = self._noisy_cell_voltages()
+        if command == 0x90:
+            return [self._frame(command, struct.pack(">h h h h", round(sum(cells) / 100), 0,
+                                                     round(30000 + self.current * 10),
+                                                     round(self.soc_percent * 10)))]
+        elif command == 0x91:
+            highest = max(range(len(cells)), key=lambda x: cells[x])
+            lowest = min(range(len(cells)), key=lambda x: cells[x])
+            return [self._frame(command, struct.pack(">h b h b 2x", cells[highest], highest + 1,
+                                                     cells[lowest], lowest + 1))]
+        elif command == 0x92:
+            highest = max(range(len(self.temperatures)), key=lambda x: self.temperatures[x])
+            lowest = min(range(len(self.temperatures)), key=lambda x: self.temperatures[x])
+            return [self._frame(command, struct.pack(">b b b b 4x", self.temperatures[highest] + 40, highest + 1,
+                                                     self.temperatures[lowest] + 40, lowest + 1))]
+        elif command == 0x93:
+            if self.current < 0:
+                mode = 1
+            elif self.current > 0:
+                mode = 2
+            else:
+                mode = 0
+            return [self._frame(command, struct.pack(">b ? ? B l", mode, self.charging_mosfet,
+                                                     self.discharging_mosfet, self.cycles & 0xFF,
+                                                     round(self.capacity_ah * self.soc_percent * 10)))]
+        elif command == 0x94:
+            return [self._frame(command, struct.pack(">b b ? ? B h x", len(cells), len(self.temperatures),
+                                                     self.current < 0, self.current > 0, 0x03, self.cycles))]
+        elif command == 0x95:
+            frames = []
+            for x in range(0, len(cells), 3):
+                values = cells[x:x + 3] + [0] * (3 - len(cells[x:x + 3]))
+                frames.append(self._frame(command, struct.pack(">b 3h x", x // 3 + 1, *values)))
+            return frames
+        elif command == 0x96:
+            frames = []
+            for x in range(0, len(self.temperatures), 7):
+                values = [t + 40 for t in self.temperatures[x:x + 7]]
+                values += [0] * (7 - len(values))
+                frames.append(self._frame(command, struct.pack(">b 7b", x // 7 + 1, *values)))
+            return frames
+        elif command == 0x97:
+            return [self._frame(command, self.balancing.to_bytes(8, byteorder='little'))]
+        elif command == 0x98:
+            return [self._frame(command, self.errors.to_bytes(8, byteorder='little'))]
+        elif command == 0xD9:
+            self.discharging_mosfet = bool(data[0])
+            return [self._frame(command, bytes(data))]
+        elif command == 0xDA:
+            self.charging_mosfet = bool(data[0])
+            return [self._frame(command, bytes(data))]
+        elif command == 0x21:
+            self.soc_percent = struct.unpack(">H", data[6:8])[0] / 10
+            return [self._frame(command, bytes(data))]
+        elif command == 0x00:
+            # the BMS restarts without responding
+            return []
+        self.logger.debug("unknown command %02x", command)
+        return []
+
+    def handle_register(self, register, length):
+        """
+        :param register: Register of the Sinowealth request
+        :param length: Number of data bytes of the request
+        :return: Response bytes
+        """
+        cells = self._noisy_cell_voltages()
+        if 1 <= register <= 10:
+            value = cells[register - 1] if register <= len(cells) else 0
+        elif register == 0x0B:
+            # unsigned mV, 10 cells at 4.5 V still fit
+            value = sum(cells)
+        elif register in (0x0C, 0x0D):
+            index = register - 0x0C
+            temperature = self.temperatures[index] if index < len(self.temperatures) else 0
+            value = 2731 + temperature * 10
+        elif register in (0x0E, 0x0F):
+            value = 2731 + 300
+        elif register == 0x10:
+            value = round(self.current * 1000)
+        elif register == 0x11:
+            value = round(self.capacity_ah * 1000)
+        elif register == 0x12:
+            value = round(self.capacity_ah * self.soc_percent * 10)
+        elif register == 0x13:
+            value = round(self.soc_percent)
+        elif register == 0x14:
+            value = self.cycles
+        elif register == 0x15:
+            value = self.discharging_mosfet << 1 | self.charging_mosfet
+        elif register == 0x16:
+            value = self.errors & 0xFFFF
+        elif register == 0x17:
+            # number of cells in the lower 4 bits
+            value = len(cells)
+        else:
+            value = 0
+        if length == 4:
+            data = struct.pack(">i", value)
+        elif register == 0x0B:
+            data = struct.pack(">H", min(value, 0xFFFF))
+        else:
+            data = struct.pack(">H", value & 0xFFFF)
+        return data + bytes([sum(data) & 0xFF])
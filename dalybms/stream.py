@@ -0,0 +1,180 @@
+"""
+Continuous reads on a fixed schedule, see DalyBMS.stream and AsyncDalyBMS.stream.
+
+The reads are scheduled on absolute deadlines (start + n * interval), so the time the bus takes doesn't add up
+over the cycles. Deadlines that passed while a read or the consumer took too long are skipped instead of being
+caught up and reported in Sample.missed.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Sample:
+    """
+    One read of a stream
+    """
+    __slots__ = ("timestamp", "late", "duration", "missed", "coalesced", "data")
+
+    def __init__(self, timestamp, late, duration, missed, coalesced, data):
+        self.timestamp = timestamp  # unix timestamp of the start of the read
+        self.late = late  # seconds between the deadline and the start of the read
+        self.duration = duration  # seconds the read took
+        self.missed = missed  # deadlines skipped since the previous sample
+        self.coalesced = coalesced  # newer samples replaced this many older ones the consumer didn't fetch in time
+        self.data = data
+
+    def to_dict(self):
+        data = self.data.to_dict() if hasattr(self.data, "to_dict") else self.data
+        return {
+            "timestamp": self.timestamp,
+            "late": self.late,
+            "duration": self.duration,
+            "missed": self.missed,
+            "coalesced": self.coalesced,
+            "data": data,
+        }
+
+
+class Schedule:
+    """
+    Absolute deadlines every 'interval' seconds, starting with the first call of next()
+    """
+
+    def __init__(self, interval):
+        if interval <= 0:
+            raise ValueError("interval has to be positive")
+        self.interval = interval
+        self.deadline = None
+
+    def next(self, now):
+        """
+        :param now: Current time of the clock the deadlines are based on
+        :return: Tuple of (seconds to wait for the next deadline, number of skipped deadlines)
+        """
+        if self.deadline is None:
+            self.deadline = now
+            return 0, 0
+        late = now - self.deadline
+        if late < self.interval:
+            return max(-late, 0), 0
+        # don't catch up, keep the phase and continue with the latest deadline that passed
+        missed = int(late // self.interval)
+        self.deadline += missed * self.interval
+        return 0, missed
+
+    def advance(self):
+        self.deadline += self.interval
+
+
+def _missed(missed, metrics, device):
+    if not missed:
+        return
+    logger.debug("%s: missed %i deadlines", device, missed)
+    if metrics:
+        metrics.count("dalybms_missed_deadlines_total", device, value=missed)
+
+
+def poll(read, interval, metrics=None, device=None):
+    """
+    Generator that calls read() on every deadline. The BMS is only read when the consumer asks for the next sample,
+    so a slow consumer leads to skipped deadlines instead of a growing backlog.
+
+    :param read: Function that returns the data of one sample
+    :param interval: Seconds between two deadlines
+    :param metrics: Metrics object that counts the missed deadlines (Default: None)
+    :param device: Device label of the metrics (Default: None)
+    :return: Generator of Sample objects
+    """
+    schedule = Schedule(interval)
+    while True:
+        wait, missed = schedule.next(time.monotonic())
+        if wait:
+            time.sleep(wait)
+        _missed(missed, metrics, device)
+        timestamp = time.time()
+        start = time.monotonic()
+        data = read()
+        end = time.monotonic()
+        yield Sample(timestamp, max(start - schedule.deadline, 0), end - start, missed, 0, data)
+        schedule.advance()
+
+
+class _Mailbox:
+    """
+    Holds the latest sample only, a new one replaces a sample that was not fetched yet
+    """
+
+    def __init__(self):
+        self.sample = None
+        self.error = None
+        self.event = asyncio.Event()
+
+    def put(self, sample):
+        if self.sample is not None:
+            sample.missed += self.sample.missed
+            sample.coalesced += self.sample.coalesced + 1
+        self.sample = sample
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    async def get(self):
+        await self.event.wait()
+        sample, self.sample = self.sample, None
+        if sample is None:
+            raise self.error
+        if self.error is None:
+            # after a failure the event stays set, so that the next get raises the error
+            self.event.clear()
+        return sample
+
+
+async def _produce(read, interval, mailbox, metrics, device):
+    loop = asyncio.get_running_loop()
+    schedule = Schedule(interval)
+    try:
+        while True:
+            wait, missed = schedule.next(loop.time())
+            if wait:
+                await asyncio.sleep(wait)
+            _missed(missed, metrics, device)
+            timestamp = time.time()
+            start = loop.time()
+            data = await read()
+            end = loop.time()
+            mailbox.put(Sample(timestamp, max(start - schedule.deadline, 0), end - start, missed, 0, data))
+            schedule.advance()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        mailbox.fail(e)
+
+
+async def async_poll(read, interval, metrics=None, device=None):
+    """
+    Async generator that awaits read() on every deadline. The reads run in a background task, independent
+    of the consumer. Only the latest sample is kept, so a slow consumer gets the newest data with the number
+    of dropped samples in Sample.coalesced, and the memory usage doesn't grow.
+
+    :param read: Coroutine function that returns the data of one sample
+    :param interval: Seconds between two deadlines
+    :param metrics: Metrics object that counts the missed deadlines (Default: None)
+    :param device: Device label of the metrics (Default: None)
+    :return: Async generator of Sample objects
+    """
+    mailbox = _Mailbox()
+    producer = asyncio.ensure_future(_produce(read, interval, mailbox, metrics, device))
+    try:
+        while True:
+            yield await mailbox.get()
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass